@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""
+Throughput benchmarks for the image parsers, run on synthetic images (see synth.py).
+
+For each format this measures
+  parse   - opening the image (constructor)
+  list    - get_metainf()
+  extract - get_archive() and writing the archive to a zip file
+as MB/s of image data, and the peak memory (tracemalloc) of each stage.
+It also checks that extracting with several threads gives the same files as with one thread.
+
+  bench.py                   # all formats, default sizes
+  bench.py -f nd -r 10 --json results.json
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+import synth
+from image_mycron import MycronDiskette
+from image_tram import TramDisk
+from image_nd import NDImage
+
+# name: (image file suffix, generator, parser)
+CASES = {
+    "mycron-prog": (".img", lambda: synth.mycron_prog(152, seg1_sectors=8, seg2_sectors=4), MycronDiskette),
+    "mycron-data": (".img", lambda: synth.mycron_data(19, file_sectors=100), MycronDiskette),
+    "tram": (".imd", lambda: synth.tram(18, lines_per_doc=168), TramDisk),
+    "nd": (".img", lambda: synth.nd(users=4, files=40, file_pages=20), NDImage),
+    "nd-imd": (".imd", lambda: synth.raw_to_imd(synth.nd(users=2, files=20, file_pages=8, subindexed=True,
+                                                        directory_first=True),
+                                               8, 1024, heads=2), NDImage),
+}
+
+
+def measure(func, trace=False):
+    """Returns (result, seconds, peak bytes allocated). The peak is only measured with trace set,
+    as tracemalloc slows down the code a lot.
+    """
+    if trace:
+        tracemalloc.start()
+    t0 = time.perf_counter()
+    res = func()
+    elapsed = time.perf_counter() - t0
+    peak = 0
+    if trace:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return res, elapsed, peak
+
+
+def bench_image(fname, parser, repeat, tmpdir):
+    times = {"parse": [], "list": [], "extract": []}
+    peaks = {}
+    zip_fname = os.path.join(tmpdir, "out.zip")
+
+    def extract(disk):
+        disk.get_archive().write_to_zip(zip_fname, compression="store")
+
+    # The parsers print progress, which is not what is measured here.
+    # The last run is only used for the memory peaks.
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for run in range(repeat + 1):
+            trace = run == repeat
+            disk, t, peaks["parse"] = measure(lambda: parser(fname), trace)
+            stage_times = [t]
+            for stage, func in (("list", disk.get_metainf), ("extract", lambda: extract(disk))):
+                _, t, peaks[stage] = measure(func, trace)
+                stage_times.append(t)
+            if not trace:
+                for stage, t in zip(times, stage_times):
+                    times[stage].append(t)
+    size = os.path.getsize(fname)
+    return {stage: {"seconds": min(ts), "median": statistics.median(ts),
+                    "mb_per_s": size / min(ts) / 1e6 if min(ts) else None, "peak_bytes": peaks[stage]}
+            for stage, ts in times.items()} | {"image_bytes": size}
+
+
+def check_threads(fname, parser, tmpdir, jobs=8, trials=5):
+    """Extracts the image to a zip file with one thread, and trials times with jobs threads.
+    Returns True if they all have the same contents. Thread switches are forced often, to give
+    races a chance to show up.
+    """
+    contents = []
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        for n in [1] + [jobs] * trials:
+            zip_fname = os.path.join(tmpdir, f"threads{n}.zip")
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                parser(fname).get_archive().write_to_zip(zip_fname, jobs=n)
+            with zipfile.ZipFile(zip_fname) as z:
+                contents.append({name: z.read(name) for name in z.namelist()})
+    finally:
+        sys.setswitchinterval(interval)
+    return all(c == contents[0] for c in contents[1:])
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark the image parsers on synthetic images")
+    ap.add_argument("-f", "--format", action="append", choices=list(CASES),
+                    help="format to benchmark (can be repeated, default all)")
+    ap.add_argument("-r", "--repeat", type=int, default=5, help="runs per format (best time is reported)")
+    ap.add_argument("--json", help="also write the results to this json file")
+    args = ap.parse_args()
+
+    results = {}
+    failed = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name in args.format or CASES:
+            suffix, generate, parser = CASES[name]
+            fname = os.path.join(tmpdir, name + suffix)
+            with open(fname, 'wb') as f:
+                f.write(generate())
+            res = results[name] = bench_image(fname, parser, args.repeat, tmpdir)
+            res["threads_same"] = check_threads(fname, parser, tmpdir)
+            print(f"{name:12} {res['image_bytes']:>9} bytes")
+            if not res["threads_same"]:
+                print("  ERROR: extracting with several threads gave different files")
+                failed.append(name)
+            for stage in ("parse", "list", "extract"):
+                r = res[stage]
+                print(f"  {stage:8} {r['seconds'] * 1e3:9.2f} ms {r['mb_per_s'] or 0:9.1f} MB/s"
+                      f"  peak {r['peak_bytes'] / 1024:9.1f} KiB")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if failed:
+        sys.exit(f"Different files when extracting with several threads: {', '.join(failed)}")
+
+
+if __name__ == '__main__':
+    main()
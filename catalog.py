@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""
+Catalog of the files on a collection of images, kept in a SQLite database.
+
+Indexing an image parses its directory and stores one row per file. Answering
+"which disk has program X" is then a query instead of re-parsing every image.
+
+  catalog.py index catalog.db images/ more-images/
+  catalog.py query catalog.db --name 'PL%'
+  catalog.py query catalog.db --format nd --year 1979
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import sqlite3
+import time
+import traceback
+import dump
+import image_common
+import image_mycron
+import image_nd
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id         INTEGER PRIMARY KEY,
+    path       TEXT UNIQUE NOT NULL,
+    format     TEXT,
+    mtime      REAL,
+    size       INTEGER,
+    indexed_at REAL,
+    version    INTEGER,
+    error      TEXT
+);
+CREATE TABLE IF NOT EXISTS files (
+    id           INTEGER PRIMARY KEY,
+    image_id     INTEGER NOT NULL REFERENCES images(id) ON DELETE CASCADE,
+    name         TEXT NOT NULL,
+    type         TEXT,
+    user         TEXT,
+    size         INTEGER,
+    created      TEXT,
+    year         INTEGER,
+    start_track  INTEGER,
+    start_sector INTEGER,
+    sectors      INTEGER,
+    meta         TEXT
+);
+-- LIKE is case insensitive, it can only use an index with the NOCASE collation
+CREATE INDEX IF NOT EXISTS files_name_nocase ON files(name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS files_type ON files(type);
+CREATE INDEX IF NOT EXISTS files_year ON files(year);
+CREATE INDEX IF NOT EXISTS files_image ON files(image_id);
+CREATE INDEX IF NOT EXISTS images_format ON images(format);
+"""
+
+FILE_COLUMNS = ("name", "type", "user", "size", "created", "year", "start_track", "start_sector", "sectors", "meta")
+
+
+def fmt_date(date):
+    return "{:04}-{:02}-{:02} {:02}:{:02}:{:02}".format(*date)
+
+
+def mycron_rows(disk):
+    for entry in disk.files:
+        if isinstance(entry, image_mycron.ProgEntry):
+            meta = entry.to_dict()
+            yield {"name": entry.name, "type": "PROG", "size": (entry.seg1sz + entry.seg2sz) * image_mycron.SECTOR_SIZE,
+                   "start_track": entry.track0, "start_sector": entry.sec0,
+                   "sectors": entry.seg1sz + entry.seg2sz, "meta": meta}
+        else:
+            meta = {"boe": entry.raw_beo, "eoe": entry.raw_eoe, "eod": entry.raw_eod, "rec_len": entry.rec_len}
+            yield {"name": entry.name, "type": "DATA", "size": len(entry.raw_file_to_eof()),
+                   "start_track": entry.start_track, "start_sector": entry.start_sect,
+                   "sectors": entry.n_sectors, "meta": meta}
+
+
+def tram_rows(disk):
+    for doc_no, fname in enumerate(disk.filenames()):
+        tracks = disk.doc_get_track_numbers(doc_no)
+        yield {"name": fname, "type": "TRAM", "start_track": tracks[0] if tracks else None,
+               "sectors": len(tracks) * 26, "meta": {"doc_no": doc_no, "tracks": tracks}}
+
+
+def nd_rows(disk):
+    for obj in disk.objects:
+        created = image_nd.parse_date(obj.date_create)
+        meta = {"pages": obj.pages_in_file, "file_pointer": obj.file_pointer,
+                "last_read": fmt_date(image_nd.parse_date(obj.date_last_rd)),
+                "last_write": fmt_date(image_nd.parse_date(obj.date_last_wr))}
+        yield {"name": obj.name, "type": obj.otype, "user": obj.user, "size": obj.file_size(),
+               "created": fmt_date(created), "year": created[0], "meta": meta}
+
+
+ROWS = {
+    "mycron": mycron_rows,
+    "tram": tram_rows,
+    "nd": nd_rows,
+}
+
+
+def scan_image(fname, disk_type=None):
+    """Parses an image and returns (format, file rows, error). Runs in a worker process."""
+    try:
+        disk_type = dump.get_disk_type(fname, disk_type)
+        disk = dump.open_disk(fname, disk_type, lazy=True)
+        return disk_type, list(ROWS[disk_type](disk)), None
+    except Exception as e:
+        return disk_type, [], f"{type(e).__name__}: {e}\n{traceback.format_exc()}"
+
+
+def open_db(fname):
+    db = sqlite3.connect(fname)
+    db.execute("PRAGMA foreign_keys = ON")
+    db.executescript(SCHEMA)
+    return db
+
+
+def store_image(db, fname, disk_type, rows, error):
+    st = os.stat(fname)
+    db.execute("DELETE FROM images WHERE path = ?", (str(fname),))
+    cur = db.execute("INSERT INTO images (path, format, mtime, size, indexed_at, version, error) "
+                     "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     (str(fname), disk_type, st.st_mtime, st.st_size, time.time(), image_common.PARSER_VERSION, error))
+    image_id = cur.lastrowid
+    db.executemany(f"INSERT INTO files (image_id, {', '.join(FILE_COLUMNS)}) VALUES (?{', ?' * len(FILE_COLUMNS)})",
+                   [(image_id, *(json.dumps(row[c]) if c == "meta" else row.get(c) for c in FILE_COLUMNS))
+                    for row in rows])
+
+
+def unchanged(db, fname):
+    """True if the image was indexed without errors before, by the same parser version and
+    with the same size and mtime
+    """
+    st = os.stat(fname)
+    row = db.execute("SELECT mtime, size, version, error FROM images WHERE path = ?", (str(fname),)).fetchone()
+    return row is not None and row == (st.st_mtime, st.st_size, image_common.PARSER_VERSION, None)
+
+
+def index_images(db, paths, pattern="*", jobs=None, disk_type=None, force=False):
+    """Indexes the images. Images that are unchanged since they were indexed are skipped (see unchanged()),
+    unless force is set.
+    """
+    images = [fname for fname, _ in dump.find_images(paths, pattern)]
+    n_found = len(images)
+    if not force:
+        images = [fname for fname in images if not unchanged(db, fname)]
+    print(f"Indexing {len(images)} images ({n_found - len(images)} unchanged)")
+    n_failed = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(scan_image, fname, disk_type): fname for fname in images}
+        for fut in concurrent.futures.as_completed(futures):
+            fname = futures[fut]
+            fmt, rows, error = fut.result()
+            store_image(db, fname, fmt, rows, error)
+            if error:
+                n_failed += 1
+                print(f" - failed {fname}: {error.splitlines()[0]}")
+    db.commit()
+    print(f"Done: {len(images) - n_failed} ok, {n_failed} failed")
+
+
+def query(db, name=None, ftype=None, year=None, fmt=None, user=None, image=None):
+    """Returns (image path, format, user, name, type, size, created) for the matching files.
+    name, image and user are SQL LIKE patterns.
+    """
+    conds = []
+    params = []
+    for col, val, op in [("files.name", name, "LIKE"), ("files.type", ftype, "="), ("files.year", year, "="),
+                         ("images.format", fmt, "="), ("files.user", user, "LIKE"), ("images.path", image, "LIKE")]:
+        if val is not None:
+            conds.append(f"{col} {op} ?")
+            params.append(val)
+    sql = ("SELECT images.path, images.format, files.user, files.name, files.type, files.size, files.created "
+           "FROM files JOIN images ON files.image_id = images.id")
+    if conds:
+        sql += " WHERE " + " AND ".join(conds)
+    sql += " ORDER BY images.path, files.id"
+    return db.execute(sql, params).fetchall()
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Catalog of the files on a collection of disk images")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    ip = sub.add_parser("index", help="add or update images in the catalog")
+    ip.add_argument("db")
+    ip.add_argument("paths", nargs='+', help="images or directories with images")
+    ip.add_argument("--pattern", default="*", help="file name pattern when searching directories (default '*')")
+    ip.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes (default: #cpus)")
+    ip.add_argument("--type", choices=list(ROWS), help="image type (default: detect)")
+    ip.add_argument("--force", action="store_true", help="also re-index images that are unchanged since they were indexed")
+
+    qp = sub.add_parser("query", help="find files in the catalog")
+    qp.add_argument("db")
+    qp.add_argument("--name", help="file name (SQL LIKE pattern, f.ex. 'PL%%')")
+    qp.add_argument("--type", help="file type (PROG, DATA, TRAM or the ND object type)")
+    qp.add_argument("--year", type=int, help="year created (ND)")
+    qp.add_argument("--format", choices=list(ROWS), help="image format")
+    qp.add_argument("--user", help="user name (ND, SQL LIKE pattern)")
+    qp.add_argument("--image", help="image path (SQL LIKE pattern)")
+    args = ap.parse_args()
+
+    db = open_db(args.db)
+    if args.cmd == "index":
+        index_images(db, args.paths, args.pattern, args.jobs, args.type, args.force)
+    else:
+        for path, fmt, user, name, ftype, size, created in query(db, args.name, args.type, args.year,
+                                                                 args.format, args.user, args.image):
+            size = "" if size is None else size
+            print(f"{path}  {fmt:6} {user or '':10} {name:16} {ftype or '':5} {size:>8} {created or ''}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,8 @@
 #!/usr/bin/env python
 
+import sys
+
+
 def hex_str(bseq):
     return ' '.join([f'{v:2x}' for v in bseq])
 
@@ -11,48 +14,88 @@ def hex_str(bseq):
 
 
 
+HEXDUMP_HEADER = "          0  1  2  3  4  5  6  7   8  9  a  b  c  d  e  f    012345678 9abcdef"
+
+# Translate tables: printable (latin1) characters for the ascii column (the rest shown as '.'),
+# and the high and low hex digit of each byte.
+_HEX_DIGITS = b"0123456789abcdef"
+_HEXDUMP_CHARS = bytes(c if chr(c).isprintable() else ord('.') for c in range(256))
+_HEXDUMP_HI = bytes(_HEX_DIGITS[c >> 4] for c in range(256))
+_HEXDUMP_LO = bytes(_HEX_DIGITS[c & 0xf] for c in range(256))
+
+_HEXDUMP_BLOCK = 0x10000    # bytes formatted (and written) at a time. Keeps the offset width fixed in a block.
+
+
+def _hexdump_short_line(offs, cur):
+    """Formats the last line of a dump, with less than 16 bytes"""
+    buf = f"   {offs:4x} "
+    buf2 = "  |"
+    for i, c in enumerate(cur):
+        buf += f" {c:02x}"
+        c = chr(c)
+        buf2 += c if c.isprintable() else '.'
+        if i == 7:
+            buf += ' '
+            buf2 += ' '
+    buf += "   " * (16 - len(cur))
+    if len(cur) < 8:
+        buf += " "
+    return f"{buf} {buf2}"
+
+
+def _hexdump_block(block, start):
+    """Formats full 16 byte lines of block (starting at offset start) as newline terminated text.
+    Every line has the same layout, so each column is filled in for all lines at once with
+    strided slice assignments, instead of formatting each line (or byte) separately.
+    """
+    n = len(block) // 16
+    width = max(4, len(f"{start + (n - 1) * 16:x}"))
+    line_len = 75 + width
+    out = bytearray(b' ') * (n * line_len)
+    offsets = ((f"%{width}x" * n) % tuple(range(start, start + n * 16, 16))).encode('ascii')
+    for i in range(width):
+        out[3 + i::line_len] = offsets[i::width]
+    hi = block.translate(_HEXDUMP_HI)
+    lo = block.translate(_HEXDUMP_LO)
+    chars = block.translate(_HEXDUMP_CHARS)
+    hex_col = 3 + width + 2
+    chr_col = hex_col + 52
+    out[chr_col - 1::line_len] = b'|' * n
+    for i in range(16):
+        gap = i >= 8             # extra space between the two groups of 8 bytes
+        pos = hex_col + 3 * i + gap
+        out[pos::line_len] = hi[i::16]
+        out[pos + 1::line_len] = lo[i::16]
+        out[chr_col + i + gap::line_len] = chars[i::16]
+    out[line_len - 1::line_len] = b'\n' * n
+    return out.decode('latin1')
+
+
+def _hexdump_text(data):
+    """Yields the hexdump of data (without the header) as chunks of newline terminated lines"""
+    data = memoryview(data).cast('B')
+    n_full = len(data) // 16 * 16
+    for start in range(0, n_full, _HEXDUMP_BLOCK):
+        yield _hexdump_block(bytes(data[start:min(start + _HEXDUMP_BLOCK, n_full)]), start)
+    if n_full < len(data):
+        yield _hexdump_short_line(n_full, data[n_full:]) + "\n"
+
+
+def write_hexdump(data, out=None):
+    """Writes a hexdump of data to the text stream out (default sys.stdout)"""
+    if out is None:
+        out = sys.stdout
+    out.write(HEXDUMP_HEADER + "\n")
+    for text in _hexdump_text(data):
+        out.write(text)
+
+
 def hexdump_data(data):
-    print("          0  1  2  3  4  5  6  7   8  9  a  b  c  d  e  f    012345678 9abcdef")
-    offs = 0
-    while len(data) > 0:
-        cur = data[:16]
-        buf = f"   {offs:4x} "
-        offs += 16
-        buf2 = "  |"
-        for i, c in enumerate(cur):
-            buf += f" {c:02x}"
-            c = chr(c)
-            buf2 += c if c.isprintable() else '.'
-            if i == 7:
-                buf += ' '
-                buf2 += ' '
-        if len(cur) < 16:
-            buf += "   " * (16 - len(cur))
-        if len(cur) < 8:
-            buf += " "
-        print(buf, buf2)
-        data = data[16:]
+    write_hexdump(data)
 
 
 def hexdump_as_lines(data):
     """Yields lines of text that can be used to print a hexdump of the provided data"""
-    yield "          0  1  2  3  4  5  6  7   8  9  a  b  c  d  e  f    012345678 9abcdef"
-    offs = 0
-    while len(data) > 0:
-        cur = data[:16]
-        buf = f"   {offs:4x} "
-        offs += 16
-        buf2 = "  |"
-        for i, c in enumerate(cur):
-            buf += f" {c:02x}"
-            c = chr(c)
-            buf2 += c if c.isprintable() else '.'
-            if i == 7:
-                buf += ' '
-                buf2 += ' '
-        if len(cur) < 16:
-            buf += "   " * (16 - len(cur))
-        if len(cur) < 8:
-            buf += " "
-        yield f"{buf} {buf2}"
-        data = data[16:]
+    yield HEXDUMP_HEADER
+    for text in _hexdump_text(data):
+        yield from text.splitlines()
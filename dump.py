@@ -1,52 +1,363 @@
 #!/usr/bin/env python
 
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import io
+import json
+import os
+import pathlib
+import sys
+import traceback
+import stats
+import image_common
 import image_mycron
 import image_tram
 import image_nd
 
 
+def get_disk_type(fname, disk_type=None):
+    """Returns disk_type, or the detected type of the image if disk_type is None"""
+    if disk_type is None:
+        disk_type = image_common.detect_format(fname)
+        if disk_type is None:
+            raise ValueError(f"{fname}: could not detect image type")
+    return disk_type
+
+
+def open_disk(fname, disk_type, verify_heads=True, lazy=False, strict=True):
+    """Opens an image. With lazy=True, only the directory structures are read up front,
+    which is enough for listing. strict=False keeps Mycron directory entries that point
+    outside of the disk (for checking). See the image classes.
+    """
+    with stats.timer("open"):
+        match disk_type:
+            case "mycron":
+                return image_mycron.MycronDiskette(fname, strict=strict)
+            case "tram":
+                return image_tram.TramDisk(fname, lazy=lazy)
+            case "nd":
+                return image_nd.NDImage(fname, verify_heads=verify_heads, lazy=lazy)
+    raise ValueError(f"Unknown disk type {disk_type}")
+
+
+def get_archive(disk):
+    with stats.timer("archive"):
+        return disk.get_archive()
+
+
+def write_archive(arch, out_format, out_path, name=None, threads=None, skip_same=False, fsync="none",
+                  compression="deflate", level=None):
+    """Writes the archive as a zip file, a directory or to a content addressed store.
+    threads is the number of threads compressing zip members or writing files to a directory.
+    skip_same and fsync are used when writing to a directory, see Archive.write_to_dir().
+    compression and level are used for zip files, see Archive.write_to_zip().
+    """
+    with stats.timer("write"):
+        match out_format:
+            case "zip":
+                arch.write_to_zip(out_path, compression=compression, level=level, jobs=threads)
+            case "dir":
+                arch.write_to_dir(out_path, jobs=threads, skip_same=skip_same, fsync=fsync)
+            case "tar":
+                arch.write_to_tar(out_path)
+            case "store":
+                arch.write_to_store(out_path, name)
+
+
+def write_stats(fname, data):
+    """Writes the stats as json to fname ('-' for stdout)"""
+    if fname == "-":
+        json.dump(data, sys.stdout, indent=2)
+        print()
+    else:
+        with open(fname, 'w') as f:
+            json.dump(data, f, indent=2)
+
+
+def find_images(paths, pattern):
+    """Expands directories in paths to the files matching pattern below them.
+    Returns a list of (image path, output name) where output name is the path relative to the
+    directory it was found in (or just the file name for files given directly).
+    """
+    images = []
+    for path in paths:
+        path = pathlib.Path(path)
+        if path.is_dir():
+            for fn in sorted(path.rglob(pattern)):
+                if fn.is_file():
+                    images.append((fn, fn.relative_to(path)))
+        else:
+            images.append((path, pathlib.Path(path.name)))
+    return images
+
+
+def output_exists(out_path, out_format, name):
+    if out_format == "store":
+        return (pathlib.Path(out_path) / "images" / f"{name}.json").exists()
+    return pathlib.Path(out_path).exists()
+
+
+def extract_image(fname, disk_type, out_path, out_format, verify_heads=True, name=None, prev=None, write_opts=None):
+    """Extracts a single image in a batch. Runs in a worker process.
+    For the store format, out_path is the object store and name is the name of the image in the store.
+    write_opts are passed on to write_archive().
+    If prev (the manifest entry for the image from an earlier run) shows that the same content was
+    extracted to the same place by the same parser version, the image is skipped. The content is
+    taken to be the same if the size and mtime are unchanged, otherwise the sha256 is compared.
+    Never raises, the result (and anything the parsers printed) is returned as a dict for the manifest.
+    """
+    result = {"image": str(fname), "type": disk_type, "output": str(out_path),
+              "version": image_common.PARSER_VERSION}
+    log = io.StringIO()
+    stats.reset()
+    try:
+        st = os.stat(fname)
+        result["size"] = st.st_size
+        result["mtime"] = st.st_mtime
+        reusable = (prev is not None and prev.get("status") == "ok"
+                    and all(prev.get(k) == result[k] for k in ("version", "output"))
+                    and output_exists(out_path, out_format, name))
+        if reusable and all(prev.get(k) == result[k] for k in ("size", "mtime")):
+            return dict(prev, skipped=True)
+        with open(fname, 'rb') as f:
+            result["sha256"] = image_common.file_sha256(f).hexdigest()
+        if reusable and prev.get("sha256") == result["sha256"]:
+            # Touched, but not changed
+            return dict(prev, size=result["size"], mtime=result["mtime"], skipped=True)
+        with contextlib.redirect_stdout(log):
+            disk_type = result["type"] = get_disk_type(fname, disk_type)
+            disk = open_disk(fname, disk_type, verify_heads=verify_heads)
+            arch = get_archive(disk)
+            pathlib.Path(out_path).parent.mkdir(parents=True, exist_ok=True)
+            if out_format == "dir":
+                pathlib.Path(out_path).mkdir(exist_ok=True)
+            write_archive(arch, out_format, out_path, name, **(write_opts or {}))
+        result["status"] = "ok"
+        result["files"] = len(arch.files)
+    except Exception as e:
+        result["status"] = "failed"
+        result["error"] = f"{type(e).__name__}: {e}"
+        result["traceback"] = traceback.format_exc()
+    result["log"] = log.getvalue()
+    result["stats"] = stats.as_dict()
+    result["skipped"] = False
+    return result
+
+
+def write_opts(args):
+    """Options for write_archive() from the command line"""
+    return {"threads": args.threads, "skip_same": args.skip_same, "fsync": args.fsync,
+            "compression": args.compression, "level": args.level}
+
+
+def run_batch(args, disk_type):
+    out_root = pathlib.Path(args.out)
+    images = find_images(args.filename, args.pattern)
+    # The output name is the path relative to the directory given (or the file name), so images
+    # with the same name from different places would overwrite each other's output
+    names = collections.Counter(rel for _, rel in images)
+    dups = sorted(str(rel) for rel, n in names.items() if n > 1)
+    if dups:
+        sys.exit(f"Several images would be extracted to the same output: {', '.join(dups)}\n"
+                 "Give their common parent directory instead, or extract them in separate runs.")
+    manifest_fname = args.manifest or out_root / "manifest.json"
+    out_root.mkdir(parents=True, exist_ok=True)
+    previous = {}
+    if args.incremental and os.path.exists(manifest_fname):
+        with open(manifest_fname) as f:
+            previous = {r["image"]: r for r in json.load(f)["images"]}
+
+    print(f"Extracting {len(images)} images to {out_root} using {args.jobs or os.cpu_count()} processes")
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {}
+        for fname, rel in images:
+            match args.format:
+                case "zip" | "tar":
+                    out_path = out_root / f"{rel}.{args.format}"
+                case "store":
+                    out_path = out_root
+                case _:
+                    out_path = out_root / rel
+            fut = pool.submit(extract_image, fname, disk_type, out_path, args.format, not args.no_verify_heads, str(rel),
+                              previous.get(str(fname)), write_opts(args))
+            futures[fut] = (fname, out_path)
+        for fut in concurrent.futures.as_completed(futures):
+            fname, out_path = futures[fut]
+            try:
+                res = fut.result()
+            except Exception as e:
+                # The worker itself died (not just the parser), f.ex. BrokenProcessPool
+                res = {"image": str(fname), "type": disk_type, "output": str(out_path),
+                       "status": "failed", "error": f"{type(e).__name__}: {e}"}
+            results.append(res)
+            if not res.get("skipped"):
+                print(f" - {res['status']:6} {fname}" + (f"  {res['error']}" if "error" in res else ""))
+
+    results.sort(key=lambda r: r["image"])
+    summary = {
+        "ok": sum(1 for r in results if r["status"] == "ok"),
+        "failed": sum(1 for r in results if r["status"] != "ok"),
+        "skipped": sum(1 for r in results if r.get("skipped")),
+    }
+    with open(manifest_fname, 'w') as f:
+        json.dump({"summary": summary, "images": results}, f, indent=2)
+    if args.stats:
+        # Only the images extracted in this run
+        total = {"timers": {}, "counters": {}}
+        for res in results:
+            if "stats" in res and not res.get("skipped"):
+                stats.merge(total, res["stats"])
+        write_stats(args.stats, total)
+    print(f"Done: {summary['ok']} ok ({summary['skipped']} unchanged), {summary['failed']} failed. Manifest in {manifest_fname}")
+
+
+# Image types that check_disk() can check
+CHECKED_TYPES = ("mycron", "nd")
+
+
+def check_disk(disk, disk_type):
+    """Runs the consistency check for the image type. Returns (ok, report lines)."""
+    if disk_type == "mycron":
+        report = disk.check_allocation()
+        return disk.allocation_ok(report), disk.format_allocation_report(report)
+    if disk_type == "nd":
+        import nd_check      # needs numpy, which is only needed for checking
+        report = nd_check.check(disk)
+        return nd_check.is_ok(report), nd_check.format_report(report)
+    raise ValueError(f"no consistency check for {disk_type} images")
+
+
+def run_check(args, disk_type):
+    """Checks the allocation of all images, returns the number of images with problems.
+    Images of a type without a check are skipped.
+    """
+    n_bad = 0
+    for fname, _ in find_images(args.filename, args.pattern):
+        try:
+            dtype = get_disk_type(str(fname), disk_type)
+            if dtype not in CHECKED_TYPES:
+                print(f"{fname}: skipped, no consistency check for {dtype} images")
+                continue
+            disk = open_disk(str(fname), dtype, lazy=True, strict=False)
+            ok, lines = check_disk(disk, dtype)
+        except Exception as e:
+            ok, lines = False, [f"ERROR: {e}"]
+        n_bad += not ok
+        print(f"{fname}: {'ok' if ok else 'PROBLEMS'}")
+        for line in lines:
+            print("  " + line)
+    return n_bad
+
+
 def main():
     parser = argparse.ArgumentParser(
         prog="Diskette Dumper",
         description="Displays info about a diskette image. Optionally extracts files and puts them in a zip file.",
         epilog="check this (TODO)")
 
-    parser.add_argument('filename')
+    parser.add_argument('filename', nargs='+',
+                        help="image file. Several images or directories of images can be given with --out (batch mode)")
 
-    # Mutually exclusive group that also requires one to be specified.
-    # TODO: could also use --type mycron|tram|nd|... 
-    # Alternatively, provide image type detection.
-    types = parser.add_mutually_exclusive_group(required=True)
+    # If no type is given, it is detected from the image.
+    types = parser.add_mutually_exclusive_group()
     types.add_argument('-tm', action="store_true", help="Image type is Mycron diskette")
     types.add_argument('-tt', action="store_true", help="Image type is Tram diskette")
     types.add_argument('-tn', action="store_true", help="Image type is ND diskette")
 
     parser.add_argument('--zip', nargs=1, help="zip file to store extracted files in")
     parser.add_argument('--dir', nargs=1, help="directory to extract files into")
+    parser.add_argument('--tar', nargs=1, metavar="TAR",
+                        help="tar file to stream extracted files to, '-' for stdout (the other output then goes to stderr)")
+    parser.add_argument('--store', nargs=1, help="content addressed store to put extracted files in (each file is stored once)")
     parser.add_argument('-l', '--ls', action="store_true", help="List files in archive")
+    parser.add_argument('--compression', choices=list(image_common.ZIP_COMPRESSION), default="deflate",
+                        help="compression of the files in zip files (default deflate)")
+    parser.add_argument('--level', type=int, default=None, help="compression level (default: the default of the compression method)")
+    parser.add_argument('--threads', type=int, default=None,
+                        help="threads compressing zip members or writing files to a directory (default: ThreadPoolExecutor default)")
+    parser.add_argument('--skip-same', action="store_true", help="don't rewrite files in a directory that have the same size and sha256")
+    parser.add_argument('--fsync', choices=["none", "batch"], default="none",
+                        help="'batch' fsyncs the files written to a directory, and the directories once all are written (default none)")
+    parser.add_argument('--no-verify-heads', action="store_true",
+                        help="Don't check that head 1 is a copy of head 0 in single sided IMD images (ND)")
+    parser.add_argument('--check', action="store_true",
+                        help="check the allocation of the images (ND: bit file against the files, needs numpy. "
+                             "Mycron: overlapping files and free space)")
+    parser.add_argument('--stats', metavar="FILE",
+                        help="write time per stage and counters (sectors/pages read, files written, ...) as json to FILE ('-' for stdout)")
+
+    batch = parser.add_argument_group("batch mode")
+    batch.add_argument('--out', help="extract all images to this directory, one zip file or directory per image")
+    batch.add_argument('--format', choices=["zip", "dir", "tar", "store"], default="zip",
+                       help="output per image (default zip). 'store' uses OUT as a content addressed store for all images")
+    batch.add_argument('-j', '--jobs', type=int, default=None, help="number of worker processes (default: #cpus)")
+    batch.add_argument('--pattern', default="*", help="file name pattern when searching directories (default '*')")
+    batch.add_argument('--manifest', help="where to store the json result manifest (default OUT/manifest.json)")
+    batch.add_argument('--incremental', action="store_true",
+                       help="skip images that were extracted before (same content and parser version, according to the manifest)")
     args = parser.parse_args()
 
-    disk = None
+    disk_type = None
     if args.tm:
-        disk = image_mycron.MycronDiskette(args.filename)
+        disk_type = "mycron"
     if args.tt:
-        disk = image_tram.TramDisk(args.filename)
+        disk_type = "tram"
     if args.tn:
-        disk = image_nd.NDImage(args.filename)
+        disk_type = "nd"
+
+    if args.check:
+        sys.exit(1 if run_check(args, disk_type) else 0)
+
+    if args.out:
+        run_batch(args, disk_type)
+        return
+
+    if len(args.filename) > 1:
+        parser.error("several images can only be extracted in batch mode (--out)")
+    if args.tar and args.tar[0] == "-":
+        # stdout is the tar stream, so everything that is printed goes to stderr
+        tar_out = sys.stdout.buffer
+        with contextlib.redirect_stdout(sys.stderr):
+            extract_single(args, disk_type, tar_out=tar_out)
+    else:
+        extract_single(args, disk_type)
+
+
+def extract_single(args, disk_type, tar_out=None):
+    fname = args.filename[0]
+    # Listing only needs the directory structures
+    list_only = not (args.zip or args.dir or args.tar or args.store)
+    disk = open_disk(fname, get_disk_type(fname, disk_type), verify_heads=not args.no_verify_heads, lazy=list_only)
 
     if args.zip:
         zip_fname = args.zip[0]
-        arch = disk.get_archive()
-        arch.write_to_zip(zip_fname)
+        arch = get_archive(disk)
+        write_archive(arch, "zip", zip_fname, **write_opts(args))
 
     if args.dir:
         dpath = args.dir[0]
-        arch = disk.get_archive()
-        arch.write_to_dir(dpath)
+        arch = get_archive(disk)
+        write_archive(arch, "dir", dpath, **write_opts(args))
+
+    if args.tar:
+        arch = get_archive(disk)
+        write_archive(arch, "tar", tar_out or args.tar[0])
+        if tar_out is not None:
+            tar_out.flush()
+
+    if args.store:
+        arch = get_archive(disk)
+        write_archive(arch, "store", args.store[0], pathlib.Path(fname).name)
 
     if args.ls:
-        print(disk.get_metainf())
+        with stats.timer("list"):
+            print(disk.get_metainf())
+
+    if args.stats:
+        write_stats(args.stats, stats.as_dict())
 
 
 if __name__ == '__main__':
@@ -8,9 +8,9 @@ import imd_common
 import argparse
 
 
-def dump_tracks(im, dump_hex=False, ss=True):
+def dump_tracks(im, dump_hex=False, ss=True, verify=True):
     if ss:
-        im = imd_common.conv_ds_to_ss(im)
+        im = imd_common.conv_ds_to_ss(im, verify=verify)
     for track in im.tracks:
         print(f"==== track/cyl-head: {track.cylinder}-{track.head} =====")
         print(track.sector_numbering_map)
@@ -25,9 +25,9 @@ def dump_tracks(im, dump_hex=False, ss=True):
                 print(f"  {tno:02}.{t.head}.{sec:02} {len(sdr.data):3}", sdr)
 
 
-def store_tracks(im, out_fname, ss=True):
+def store_tracks(im, out_fname, ss=True, verify=True):
     if ss:
-        im = imd_common.conv_ds_to_ss(im)
+        im = imd_common.conv_ds_to_ss(im, verify=verify)
     with open(out_fname, 'wb') as out:
         nsects = 0
         print(f"Duming raw image to {out_fname}")
@@ -45,9 +45,9 @@ def store_tracks(im, out_fname, ss=True):
         print(f" - done - wrote {nsects} sectors.")
 
 
-def store_imd(im, out_fname, ss=True):
+def store_imd(im, out_fname, ss=True, verify=True):
     if ss:
-        im = imd_common.conv_ds_to_ss(im)
+        im = imd_common.conv_ds_to_ss(im, verify=verify)
     with open(out_fname, 'wb') as out:
         print(f"Dumping IMD to {out_fname}")
         out.write(im.to_bytes())
@@ -67,6 +67,7 @@ if __name__ == "__main__":
     ap.add_argument("-toimd", nargs=1)
     ap.add_argument("fname",  default="nd01.imd")
     ap.add_argument("-ds",    action="store_true", help="Process as double sided")
+    ap.add_argument("-noverify", action="store_true", help="Don't check that head 1 is a copy of head 0 when converting to single sided")
     ap.add_argument("-hdr",   action="store_true", help="Print IMD header")
     ap.add_argument("-ce",    action="store_true", help="Prints sectors that have errors")
     args = ap.parse_args()
@@ -77,12 +78,12 @@ if __name__ == "__main__":
     print(f"Date {d.date} Comment {d.comment.strip()} Version {d.version} #tracks {len(d.tracks)}")
 
     if all(not x for x in [args.toraw, args.toimd, args.hdr, args.ce]):
-        dump_tracks(d, dump_hex=args.hex, ss=not args.ds)
+        dump_tracks(d, dump_hex=args.hex, ss=not args.ds, verify=not args.noverify)
     else:
         if args.toraw is not None:
-            store_tracks(d, args.toraw[0], ss=not args.ds)
+            store_tracks(d, args.toraw[0], ss=not args.ds, verify=not args.noverify)
         if args.toimd is not None:
-            store_imd(d, args.toimd[0], ss=not args.ds)
+            store_imd(d, args.toimd[0], ss=not args.ds, verify=not args.noverify)
         if args.hdr:
             print("HDR from", args.fname)
             print(d.version)
@@ -1,8 +1,27 @@
 #!/usr/bin/env python
 
+import os
+import io
+import json
+import mmap
+import time
+import hashlib
+import concurrent.futures
+import struct
+import tempfile
+import tarfile
 import zipfile
+import zlib
+import bz2
+import lzma
+import collections
 import pathlib
 import itertools
+import stats
+
+# Bump this when a change in the parsers changes what is extracted from an image.
+# Incremental batch runs (dump.py --incremental) re-extract images done with another version.
+PARSER_VERSION = 1
 
 # The first generations of Mycron computers used Single Side Single Density diskettes.
 TRACKS      =  77       # tracks are numbered 0..76
@@ -10,25 +29,63 @@ SECTORS     =  26       # sectors are numbered 1..26
 SECTOR_SIZE = 128
 
 
-def split_disk(data, tracks=TRACKS, sectors=SECTORS, sector_size=SECTOR_SIZE):
-    """splits a disk into tracks and sectors
-    returns a (track,sector) list
+class RawImage:
+    """A raw (headerless) disk image, addressed by (track, sector) or by page.
+
+    The file is memory mapped and sectors/pages are handed out as memoryviews into
+    the map, so nothing is copied until the caller actually needs the bytes.
+    Sectors are numbered 1..sectors (as in the mycron docs), tracks from 0.
     """
-    disk = {}
-    assert len(data) % sector_size == 0
-    assert len(data) == tracks * sectors * sector_size
-    for track in range(tracks):
-        # print(track, end=' ')
-        for sector in range(sectors):
-            # print(f's{sector}', end=',')
-            offset = (track * sectors + sector ) * sector_size
-            d = data[offset:offset + sector_size]
-            assert len(d) == sector_size
-            # looks like the mycron docs address sectors 1..26
-            disk[(track, sector + 1)] = d
-        # print()
-    # print(track * sector * sector_size + sector_size)
-    return disk
+    def __init__(self, data, sectors=SECTORS, sector_size=SECTOR_SIZE):
+        self.data = memoryview(data)
+        self.sectors = sectors
+        self.sector_size = sector_size
+
+    @classmethod
+    def from_file(cls, fname, **kwargs):
+        with open(fname, 'rb') as f:
+            # The map keeps its own reference to the file, so it's safe to close f.
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(mm, **kwargs)
+
+    def __len__(self):
+        return len(self.data)
+
+    def sector_offset(self, track, sector):
+        """Byte offset of track/sector in the image"""
+        return sect_index(track, sector, self.sectors) * self.sector_size
+
+    def get_sector(self, track, sector):
+        if not (1 <= sector <= self.sectors):
+            raise ValueError(f"Invalid sector number {track}.{sector}")
+        stats.count("sectors_read")
+        offs = self.sector_offset(track, sector)
+        sect = self.data[offs:offs + self.sector_size]
+        if len(sect) != self.sector_size:
+            raise ValueError(f"Sector {track}.{sector} is outside of the image")
+        return sect
+
+    def check_sectors(self, track, sector, count):
+        """Raises ValueError unless the count sectors starting at track/sector are in the image"""
+        offs = self.sector_offset(track, sector)
+        if offs < 0 or count < 0 or offs + count * self.sector_size > len(self.data):
+            raise ValueError(f"Sectors {track}.{sector} + {count} are outside of the image")
+
+    def get_sectors(self, track, sector, count):
+        """Returns count consecutive sectors, starting at track/sector, as one memoryview"""
+        self.check_sectors(track, sector, count)
+        offs = self.sector_offset(track, sector)
+        stats.count("sectors_read", count)
+        return self.data[offs:offs + count * self.sector_size]
+
+    def get_page(self, pno, page_size):
+        """Returns page pno, where the image is seen as a sequence of page_size byte pages"""
+        if not isinstance(pno, int) or pno < 0:
+            raise ValueError(f"Invalid page number: {pno!r}")
+        page = self.data[pno * page_size:(pno + 1) * page_size]
+        if len(page) != page_size:
+            raise ValueError(f"Page is len {len(page)} - should be {page_size}")
+        return page
 
 
 def split_sect(sect, psize):
@@ -39,21 +96,20 @@ def split_sect(sect, psize):
     return parts
 
 
+def sect_index(track, sect, num_sectors=SECTORS):
+    """Linear (0 based) sector number of track/sect, with sectors numbered from 1"""
+    return track * num_sectors + sect - 1
+
+
 def add_sects(track, sect, nsect, num_sectors=SECTORS):
     """add sectors to address starting at track and sect, returning track,sect or
     result"""
-    # TODO: I'm just tired now, and I can't use modulo here - at least not without thinking.
-    # The solution is probably to reduce sect with 1 to work with base 0 and then just add 1 to the result
-    for _ in range(nsect):
-        sect += 1
-        if sect > num_sectors:
-            sect = 1
-            track += 1
-    return track, sect
+    idx = sect_index(track, sect, num_sectors) + nsect
+    return idx // num_sectors, idx % num_sectors + 1
 
 
 def extract_ascii(sect, start, stop):
-    part = sect[start:stop]
+    part = bytes(sect[start:stop])
     try:
         return part.decode('ASCII')
     except UnicodeDecodeError:
@@ -61,12 +117,80 @@ def extract_ascii(sect, start, stop):
         raise
 
 
+class ProbeInput:
+    """What the format probes get to look at: the size of the image file, its first
+    4 bytes and any other bytes they ask for. Probes should read as little as possible.
+    """
+    def __init__(self, fname, f):
+        self.fname = fname
+        self.f = f
+        self.size = os.fstat(f.fileno()).st_size
+        self.magic = self.read(0, 4)
+        self.cache = {}      # for sharing parsed data between probes
+
+    def read(self, offset, length):
+        self.f.seek(offset)
+        return self.f.read(length)
+
+
+# Image format probes, registered by the image modules: name -> probe function.
+# A probe function takes a ProbeInput and returns True if it recognizes the format.
+PROBES = {}
+
+
+def register_probe(name, probe):
+    PROBES[name] = probe
+
+
+def detect_format(fname):
+    """Returns the name of the first registered format that recognizes the image, or None"""
+    with open(fname, 'rb') as f:
+        probe = ProbeInput(fname, f)
+        for name, probe_func in PROBES.items():
+            if probe_func(probe):
+                return name
+    return None
+
+
 # NB: a given archive should present metadata files as .meta files
 class File:
-    def __init__(self, path, data):
+    """A file in an archive.
+    data is either the contents (bytes-like), or a function returning an iterable of bytes-like
+    chunks (f.ex. a generator of pages). The function is only called when the file is written,
+    so the archive doesn't need to keep the contents of all files in memory.
+    size can be given for lazy files if it is known up front (None if unknown).
+    """
+    def __init__(self, path, data, size=None):
         self.path = path
-        self.data = data
-        assert isinstance(self.data, (bytes, bytearray))
+        self._data = data
+        if callable(data):
+            self.size = size
+        else:
+            assert isinstance(data, (bytes, bytearray, memoryview))
+            self.size = len(data)
+
+    def chunks(self):
+        """Yields the contents of the file in chunks"""
+        if callable(self._data):
+            # Lazy files are assembled here, while they are written
+            yield from stats.timed_iter("assemble", self._data())
+        else:
+            yield self._data
+
+    @property
+    def data(self):
+        """The full contents of the file. NB: this reads all of a lazy file into memory."""
+        if callable(self._data):
+            return b''.join(self.chunks())
+        return self._data
+
+
+def file_sha256(f, chunk_size=1 << 20):
+    """Returns the sha256 of the rest of the binary file object f, read chunk_size bytes at a time"""
+    digest = hashlib.sha256()
+    while chunk := f.read(chunk_size):
+        digest.update(chunk)
+    return digest
 
 
 def ensure_dir(path):
@@ -77,6 +201,169 @@ def ensure_dir(path):
         path.parent.mkdir(parents=True, exist_ok=True)
 
 
+# Compression methods for Archive.write_to_zip()
+ZIP_COMPRESSION = {
+    "store": zipfile.ZIP_STORED,
+    "deflate": zipfile.ZIP_DEFLATED,
+    "bzip2": zipfile.ZIP_BZIP2,
+    "lzma": zipfile.ZIP_LZMA,
+}
+
+
+# Version needed to extract, by compression method
+_ZIP_VERSION = {
+    zipfile.ZIP_STORED: 20,
+    zipfile.ZIP_DEFLATED: 20,
+    zipfile.ZIP_BZIP2: 46,
+    zipfile.ZIP_LZMA: 63,
+}
+
+# LZMA members use the same settings as zipfile: lc=3, lp=0, pb=2 and an 8 MiB dictionary.
+# The properties are encoded as ((pb * 5 + lp) * 9 + lc), dictionary size.
+_LZMA_FILTER = {"id": lzma.FILTER_LZMA1, "lc": 3, "lp": 0, "pb": 2, "dict_size": 1 << 23}
+_LZMA_PROPS = struct.pack("<BL", (2 * 5 + 0) * 9 + 3, 1 << 23)
+
+
+def _compressor(compress_type, level):
+    """Returns (compressor, header) for a zip compression method. The compressor has compress() and
+    flush() (None for store), the header goes in front of the compressed data.
+    level is None for the default, and is ignored for lzma (as by zipfile).
+    """
+    match compress_type:
+        case zipfile.ZIP_STORED:
+            return None, b""
+        case zipfile.ZIP_DEFLATED:
+            return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION if level is None else level, zlib.DEFLATED, -15), b""
+        case zipfile.ZIP_BZIP2:
+            return bz2.BZ2Compressor(9 if level is None else level), b""
+        case zipfile.ZIP_LZMA:
+            return (lzma.LZMACompressor(lzma.FORMAT_RAW, filters=[_LZMA_FILTER]),
+                    struct.pack("<BBH", 9, 4, len(_LZMA_PROPS)) + _LZMA_PROPS)
+    raise ValueError(f"Unknown zip compression {compress_type}")
+
+
+def _compress_member(file, compress_type, level):
+    """Returns (size, crc, compressed data) of a file. Runs in a worker thread (zlib, bz2 and lzma release the GIL)."""
+    compressor, header = _compressor(compress_type, level)
+    size = crc = 0
+    parts = [header]
+    for chunk in file.chunks():
+        size += len(chunk)
+        crc = zlib.crc32(chunk, crc)
+        parts.append(compressor.compress(chunk) if compressor else bytes(chunk))
+    if compressor:
+        parts.append(compressor.flush())
+    return size, crc, b"".join(parts)
+
+
+class _ZipWriter:
+    """Writes a zip file from members that are already compressed, see _compress_member().
+    There is no zip64 support: members and the zip file are limited to 4 GiB, and to 65535 members.
+    """
+    LOCAL_HEADER = struct.Struct("<4sHHHHHLLLHH")
+    CENTRAL_HEADER = struct.Struct("<4sBBHHHHHLLLHHHHHLL")
+    END_OF_CENTRAL_DIR = struct.Struct("<4sHHHHLLH")
+
+    def __init__(self, f):
+        self.f = f
+        self.offset = 0
+        self.central_dir = []
+
+    def _write(self, data):
+        self.f.write(data)
+        self.offset += len(data)
+
+    def add(self, name, compress_type, size, crc, data, date_time, external_attr=0o600 << 16):
+        """Adds a member. date_time is (year, month, day, hour, min, sec) as for zipfile.ZipInfo."""
+        try:
+            fname = name.encode("ascii")
+            flags = 0
+        except UnicodeEncodeError:
+            fname = name.encode("utf-8")
+            flags = 0x800
+        if compress_type == zipfile.ZIP_LZMA:
+            flags |= 0x02       # the compressed data has an end of stream marker
+        if max(self.offset, size, len(data)) > 0xffffffff:
+            raise ValueError(f"{name}: zip files and members over 4 GiB are not supported")
+        version = _ZIP_VERSION[compress_type]
+        year, month, day, hour, minute, sec = date_time
+        dos_time = hour << 11 | minute << 5 | sec // 2
+        dos_date = (year - 1980) << 9 | month << 5 | day
+        self.central_dir.append(self.CENTRAL_HEADER.pack(
+            b"PK\x01\x02", version, 3, version, flags, compress_type, dos_time, dos_date, crc, len(data), size,
+            len(fname), 0, 0, 0, 0, external_attr, self.offset) + fname)
+        self._write(self.LOCAL_HEADER.pack(b"PK\x03\x04", version, flags, compress_type, dos_time, dos_date,
+                                           crc, len(data), size, len(fname), 0))
+        self._write(fname)
+        self._write(data)
+
+    def close(self):
+        """Writes the central directory"""
+        n = len(self.central_dir)
+        if n > 0xffff or self.offset > 0xffffffff:
+            raise ValueError("zip files with more than 65535 members or over 4 GiB are not supported")
+        start = self.offset
+        for entry in self.central_dir:
+            self._write(entry)
+        self._write(self.END_OF_CENTRAL_DIR.pack(b"PK\x05\x06", 0, 0, n, n, self.offset - start, start, 0))
+
+
+class _ChunkReader:
+    """Minimal read only file object on top of an iterable of chunks"""
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = bytearray()
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buf) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buf += chunk
+        if size < 0:
+            size = len(self.buf)
+        data = bytes(self.buf[:size])
+        del self.buf[:size]
+        return data
+
+
+def _write_file(fn, file, skip_same=False, fsync=False):
+    """Writes file to fn, and flushes it to disk if fsync is set.
+    Returns False if skip_same is set and fn already has the same contents.
+    """
+    chunks = file.chunks()
+    if skip_same and fn.exists() and file.size in (None, fn.stat().st_size):
+        # The contents are needed both for the hash and (if it differs) for writing it
+        chunks = list(chunks)
+        digest = hashlib.sha256()
+        for chunk in chunks:
+            digest.update(chunk)
+        with open(fn, 'rb') as f:
+            if file_sha256(f).digest() == digest.digest():
+                return False
+    with open(fn, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+            stats.count("bytes_written", len(chunk))
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    stats.count("files_written")
+    return True
+
+
+def _fsync_dir(path):
+    """Flushes the directory entries of path to disk (where directories can be opened)"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return      # f.ex. Windows
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
 class Archive:
     """Keeps a list of files extracted from a disk"""
     def __init__(self, fname):
@@ -88,31 +375,154 @@ class Archive:
         if file.path in self.files:
             print(f"Path to file '{file.path}' added previously.")
             for count in itertools.count():
-                if (new_fn := f"{file.path}--duplicate-{fnum:03d}") not in self.files:
+                if (new_fn := f"{file.path}--duplicate-{count:03d}") not in self.files:
                     print(f"Adding file as {new_fn}")
                     file.path = new_fn
                     self.files[new_fn] = file
                     return
         self.files[file.path] = file
 
-    def write_to_zip(self, fname):
+    def write_to_zip(self, fname, compression="deflate", level=None, jobs=None):
+        """Writes the files to zip file fname.
+        compression is one of ZIP_COMPRESSION, level is the compression level (None for the default).
+        The members are compressed by a pool of jobs threads (zlib, bz2 and lzma release the GIL),
+        and written to the zip file in the same order as the files in the archive. At most 2 * jobs
+        compressed members are waiting to be written.
+        """
         print("Storing in zip file:", fname)
-        with zipfile.ZipFile(fname, 'w') as zfile:
+        compress_type = ZIP_COMPRESSION[compression]
+        # Same timestamp for all members, as writestr uses the current time
+        date_time = time.localtime(time.time())[:6]
+        with open(fname, 'wb') as f, concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            zfile = _ZipWriter(f)
+            # Limit the number of compressed members waiting to be written
+            window = 2 * (jobs or min(32, (os.cpu_count() or 1) + 4))
+            pending = collections.deque()
             for file in self.files.values():
-                print(" - ", file.path)
-                # writestr also handles bytes.
-                zfile.writestr(file.path, file.data)
+                pending.append((file, pool.submit(_compress_member, file, compress_type, level)))
+                if len(pending) > window:
+                    self._write_zip_member(zfile, *pending.popleft(), compress_type, date_time)
+            while pending:
+                self._write_zip_member(zfile, *pending.popleft(), compress_type, date_time)
+            zfile.close()
+
+    @staticmethod
+    def _write_zip_member(zfile, file, future, compress_type, date_time):
+        """Writes a compressed member. bytes_written counts the uncompressed bytes, as for the other formats."""
+        size, crc, data = future.result()
+        print(" - ", file.path)
+        zfile.add(file.path, compress_type, size, crc, data, date_time)
+        stats.count("bytes_written", size)
+        stats.count("files_written")
 
-    def write_to_dir(self, fname):
+    def write_to_dir(self, fname, jobs=None, skip_same=False, fsync="none"):
+        """Writes the files to directory fname, using a pool of jobs threads (default: see ThreadPoolExecutor).
+        The directory tree is created up front. With skip_same, existing files with the same size and
+        sha256 are left alone. fsync is "none" (leave it to the OS) or "batch" (each file is fsynced by the
+        thread writing it, and the directories written to are fsynced once all files are written).
+        """
         dpath = pathlib.Path(fname)
         if not dpath.exists() or not dpath.is_dir():
             print("Can't dump to nonexisting directory", dpath)
             return
 
         print("Extracting to directory:", dpath)
+        for subdir in sorted({(dpath / file.path).parent for file in self.files.values()}):
+            subdir.mkdir(parents=True, exist_ok=True)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = [(dpath / file.path, pool.submit(_write_file, dpath / file.path, file, skip_same, fsync == "batch"))
+                       for file in self.files.values()]
+        n_written = 0
+        for fn, fut in futures:
+            written = fut.result()
+            n_written += written
+            if written:
+                print("  - ", fn)
+            else:
+                print("  - ", fn, "(unchanged)")
+        if fsync == "batch" and n_written:
+            for subdir in sorted({fn.parent for fn, fut in futures if fut.result()}):
+                _fsync_dir(subdir)
+        stats.count("files_unchanged", len(futures) - n_written)
+
+    def write_to_tar(self, out):
+        """Writes the files as a tar stream to out, a file name or a binary file object (f.ex. sys.stdout.buffer).
+        Files are written one at a time, as they are produced. Files with a known size are streamed
+        straight into the tar file, other lazy files are read into memory first (the size goes in the
+        tar header, in front of the contents).
+        """
+        print("Storing in tar file:", getattr(out, "name", out))
+        mtime = time.time()
+        if isinstance(out, (str, os.PathLike)):
+            tar = tarfile.open(out, 'w|')
+        else:
+            tar = tarfile.open(fileobj=out, mode='w|')
+        with tar:
+            for file in self.files.values():
+                print(" - ", file.path)
+                info = tarfile.TarInfo(file.path)
+                info.mtime = mtime
+                info.mode = 0o600
+                if file.size is None:
+                    data = file.data
+                    info.size = len(data)
+                    tar.addfile(info, io.BytesIO(data))
+                else:
+                    info.size = file.size
+                    tar.addfile(info, _ChunkReader(file.chunks()))
+                stats.count("bytes_written", info.size)
+                stats.count("files_written")
+
+    def write_to_store(self, store, name, link_dir=None):
+        """Stores the files in a content addressed object store, where each file is stored once
+        as objects/<sha256[:2]>/<sha256[2:]> no matter how many images it is found on.
+        The paths of the files on this image are recorded in images/<name>.json.
+        If link_dir is given, the image's directory tree is recreated there with hard links to the objects.
+        """
+        store = pathlib.Path(store)
+        print("Storing in object store:", store, "as", name)
+        index = {}
+        n_new = 0
+        objects = store / "objects"
+        objects.mkdir(parents=True, exist_ok=True)
         for file in self.files.values():
-            fn = dpath / file.path
-            ensure_dir(fn)
-            print("  - ", fn)
-            with open(fn, 'wb') as f:
-                f.write(file.data)
+            # The hash decides where the file goes, so the file is streamed to a temporary file
+            # (so parallel writers never see half an object) while it's hashed, and then moved in place.
+            digest = hashlib.sha256()
+            size = 0
+            with tempfile.NamedTemporaryFile(dir=objects, delete=False) as f:
+                try:
+                    for chunk in file.chunks():
+                        f.write(chunk)
+                        digest.update(chunk)
+                        size += len(chunk)
+                except BaseException:
+                    os.unlink(f.name)
+                    raise
+            digest = digest.hexdigest()
+            obj = objects / digest[:2] / digest[2:]
+            if obj.exists():
+                os.unlink(f.name)
+            else:
+                obj.parent.mkdir(exist_ok=True)
+                # NamedTemporaryFile creates the file as 0600
+                os.chmod(f.name, 0o644)
+                os.replace(f.name, obj)
+                n_new += 1
+                stats.count("files_written")
+                stats.count("bytes_written", size)
+            print(f" - {digest[:12]} {file.path}")
+            index[file.path] = {"sha256": digest, "size": size}
+            if link_dir is not None:
+                fn = pathlib.Path(link_dir) / file.path
+                fn.parent.mkdir(parents=True, exist_ok=True)
+                if fn.exists():
+                    fn.unlink()
+                os.link(obj, fn)
+
+        index_fn = store / "images" / f"{name}.json"
+        index_fn.parent.mkdir(parents=True, exist_ok=True)
+        with open(index_fn, 'w') as f:
+            json.dump({"image": str(self.fname), "files": index}, f, indent=2)
+        print(f" - {n_new} new objects, {len(index) - n_new} already in store")
+        return index
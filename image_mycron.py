@@ -11,10 +11,12 @@ TODO:
 
 """
 import struct
+import threading
 import image_common
 import json
-from image_common import split_disk, split_sect, add_sects, extract_ascii
-from image_common import File, Archive
+import stats
+from image_common import split_sect, add_sects, sect_index, extract_ascii
+from image_common import File, Archive, RawImage, register_probe
 
 # The first generations of Mycron computers used Single Side Single Density diskettes.
 TRACKS=77        # tracks are numbered 0..76
@@ -36,12 +38,7 @@ SECTOR_SIZE=128
 class ProgEntry:
     def __init__(self, ebytes, disk):
         self.ebytes = ebytes
-        self.name = ebytes[:8].decode("ASCII").strip()
-        # Set these to non-values in case it is necessary to bail out early from construction (valid=False)
-        self.sects1 = {}
-        self.sects2 = {}
-        self.seg1 = b''
-        self.seg2 = b''
+        self.name = bytes(ebytes[:8]).decode("ASCII").strip()
         self.valid = bool(self.name)  # TODO: could also check if the other vars are also 0
         if not self.valid:
             return
@@ -54,13 +51,25 @@ class ProgEntry:
             self.valid = False
             return
 
-        et1, es1 = add_sects(self.track0, self.sec0, self.seg1sz)
-        et2, es2 = add_sects(et1, es1, self.seg2sz)
+        # The segments are stored back to back. They are read when they are used.
+        self.disk = disk
+        disk.check_extent(self.track0, self.sec0, self.seg1sz + self.seg2sz)
 
-        self.sects1 = disk.get_sectors(self.track0, self.sec0, et1, es1)
-        self.sects2 = disk.get_sectors(et1, es1, et2, es2)
-        self.seg1 = b''.join(self.sects1.values())
-        self.seg2 = b''.join(self.sects2.values())
+    def extent(self):
+        """(first linear sector, number of sectors, owner) of the segments on the disk"""
+        return sect_index(self.track0, self.sec0), self.seg1sz + self.seg2sz, self.name
+
+    @property
+    def seg1(self):
+        if not self.valid:
+            return b''
+        return self.disk.read_extent(self.track0, self.sec0, self.seg1sz)
+
+    @property
+    def seg2(self):
+        if not self.valid:
+            return b''
+        return self.disk.read_extent(*add_sects(self.track0, self.sec0, self.seg1sz), self.seg2sz)
 
     def to_dict(self):
         # NB: json does not support hex addrs
@@ -75,25 +84,25 @@ class ProgEntry:
             "name" : self.name,
             "disk_start": {"track" : self.track0, "sector" : self.sec0},
             "segments" : [
-                make_seg(1, self.seg1addr, self.seg1sz, len(self.seg1)),
-                make_seg(2, self.seg2addr, self.seg2sz, len(self.seg2)),
+                make_seg(1, self.seg1addr, self.seg1sz, self.seg1sz * SECTOR_SIZE),
+                make_seg(2, self.seg2addr, self.seg2sz, self.seg2sz * SECTOR_SIZE),
             ]
         }
 
     def __str__(self):
         s = f"ProgEntry({self.name:8}, t/s0={self.track0:2}.{self.sec0:2}, "
-        s += f"seg 1 at {self.seg1addr:#6x} sz {self.seg1sz:#6x} len {len(self.seg1):#6x}, "
-        s += f"seg 2 at {self.seg2addr:#6x} sz {self.seg2sz:#6x} len {len(self.seg2):#6x}) "
+        s += f"seg 1 at {self.seg1addr:#6x} sz {self.seg1sz:#6x} len {self.seg1sz * SECTOR_SIZE:#6x}, "
+        s += f"seg 2 at {self.seg2addr:#6x} sz {self.seg2sz:#6x} len {self.seg2sz * SECTOR_SIZE:#6x}) "
         # s += str(self.ebytes)
         return s
 
     def files(self):
         yield File(f"{self.name}.meta", bytes(str(self) + "\n", encoding="ascii"))
         yield File(f"{self.name}.meta.json", bytes(json.dumps(self.to_dict()) + "\n", encoding="ascii"))
-        if len(self.seg1) > 0:
-            yield File(f"{self.name}.seg1.bin", self.seg1)
-        if len(self.seg2) > 0:
-            yield File(f"{self.name}.seg2.bin", self.seg2)
+        if self.seg1sz > 0:
+            yield File(f"{self.name}.seg1.bin", lambda: [self.seg1], size=self.seg1sz * SECTOR_SIZE)
+        if self.seg2sz > 0:
+            yield File(f"{self.name}.seg2.bin", lambda: [self.seg2], size=self.seg2sz * SECTOR_SIZE)
 
 
 # positions starting with 1 (not 0) in the docs
@@ -123,7 +132,7 @@ class DataEntry:
     def verify_data_entry(cls, sect):
         """True if this seems to be a sector describing a data file entry"""
         try:
-            hdr = sect[:5].decode("ASCII")
+            hdr = bytes(sect[:5]).decode("ASCII")
         except:
             # print("Couldn't decode", sect[:5])
             return False
@@ -134,7 +143,7 @@ class DataEntry:
     def __init__(self, sect, disk):
         self.sect = sect
         try:
-            self.ascii = sect.decode('ascii')
+            self.ascii = bytes(sect).decode('ascii')
         except:
             print("Could not decode", sect)
             raise
@@ -155,57 +164,169 @@ class DataEntry:
         self.eda_track = int(self.raw_eod[:2])
         self.eda_sect  = int(self.raw_eod[3:])
 
-        self.fsectors = disk.get_sectors(self.start_track, self.start_sect, self.eda_track, self.eda_sect)
-        self.raw_file = b''.join(s for s in self.fsectors.values())
+        # The file is read when it is used
+        self.disk = disk
+        self.n_sectors = max(sect_index(self.eda_track, self.eda_sect) - sect_index(self.start_track, self.start_sect), 0)
+        disk.check_extent(self.start_track, self.start_sect, self.n_sectors)
+
+    def extent(self):
+        """(first linear sector, number of sectors, owner) of the data set on the disk. This is BOE to EOE,
+        or up to EOD if the end of data is (wrongly) past the end of the extent.
+        """
+        first = sect_index(self.start_track, self.start_sect)
+        end = max(sect_index(self.end_track, self.end_sect) + 1, first + self.n_sectors)
+        return first, end - first, self.name
+
+    @property
+    def raw_file(self):
+        return self.disk.get_sectors(self.start_track, self.start_sect, self.eda_track, self.eda_sect)
 
     def _sub(self, start, end):
         return self.ascii[start-1:end]
 
     def ascii_file(self):
         """Returns an ascii file, trimmed at the EOF mark"""
-        txt = self.raw_file.decode('ascii')
+        txt = bytes(self.raw_file).decode('ascii')
         n_eof = txt.count('\000')
         # assert n_eof <= 1
         txt = txt.split('\000')[0]
         return txt
 
     def raw_file_to_eof(self):
-        return self.raw_file.partition(b'\x00')[0]
+        return bytes(self.raw_file).partition(b'\x00')[0]
 
     def files(self, dump_raw=True):
         if dump_raw:
-            data = self.raw_file_to_eof()
+            yield File(self.name, lambda: [self.raw_file_to_eof()])
         else:
-            data = self.ascii_file().encode('ascii')
-        yield File(self.name, data)
+            yield File(self.name, lambda: [self.ascii_file().encode('ascii')])
 
     def __str__(self):
-        s = f"DataEntry({self.name:8}, len {len(self.raw_file_to_eof()):7}, start {self.start_track:02}.{self.start_sect:02})"
+        # Only uses the directory entry, the length up to EOF would need the file to be read
+        s = f"DataEntry({self.name:8}, sectors {self.n_sectors:4}, start {self.start_track:02}.{self.start_sect:02}, "
+        s += f"eod {self.eda_track:02}.{self.eda_sect:02})"
         return s
 
 
-class MycronDiskette:
+def probe(img):
+    """Raw image of the right size (or SCP flux capture) with VOL1 or PROG at the start of sector 00.07"""
+    if img.magic[:3] == b'SCP':
+        import imd_common    # python-imd (and numpy) are only needed for flux captures
+        im = imd_common.probe_imd(img)
+        try:
+            return im is not None and im.get_sector(0, 0, 7)[:4] in (b'VOL1', b'PROG')
+        except (KeyError, ValueError):
+            return False
+    return img.size == TRACKS * SECTORS * SECTOR_SIZE and img.read(6 * SECTOR_SIZE, 4) in (b'VOL1', b'PROG')
+
+
+register_probe("mycron", probe)
+
+
+def _ts(idx):
+    """Linear sector number as tt.ss"""
+    return f"{idx // SECTORS:02}.{idx % SECTORS + 1:02}"
+
+
+class CaptureImage(RawImage):
+    """Head 0 of a flux capture (see scp.py) as a raw image. A track is decoded when its sectors
+    are first read, so listing only decodes track 0. Sectors that can't be read are zero filled.
+    """
     def __init__(self, fname):
+        import imd_common    # python-imd (and numpy) are only needed for flux captures
+        super().__init__(bytearray(TRACKS * SECTORS * SECTOR_SIZE), sectors=SECTORS, sector_size=SECTOR_SIZE)
+        self.fname = fname
+        self.capture = imd_common.open_capture(fname)
+        self._decoded = set()
+        self._lock = threading.Lock()     # the files can be read from several threads
+
+    def _decode(self, first_track, last_track):
+        """Decodes the tracks first_track..last_track that haven't been decoded yet"""
+        with self._lock:
+            for track in range(max(first_track, 0), min(last_track, TRACKS - 1) + 1):
+                if track in self._decoded:
+                    continue
+                for sect in range(1, SECTORS + 1):
+                    try:
+                        sdata = bytes(self.capture.get_sector(track, 0, sect))
+                    except (KeyError, ValueError):
+                        sdata = None
+                    if sdata is None or len(sdata) != SECTOR_SIZE:
+                        print(f"WARNING: {self.fname}: sector {track:02}.{sect:02} is unavailable, filled with zeros")
+                        continue
+                    offs = self.sector_offset(track, sect)
+                    self.data[offs:offs + SECTOR_SIZE] = sdata
+                self._decoded.add(track)
+
+    def get_sector(self, track, sector):
+        self._decode(track, track)
+        return super().get_sector(track, sector)
+
+    def get_sectors(self, track, sector, count):
+        self.check_sectors(track, sector, count)
+        first = sect_index(track, sector, SECTORS)
+        self._decode(first // SECTORS, (first + count - 1) // SECTORS)
+        return super().get_sectors(track, sector, count)
+
+    def get_page(self, pno, page_size):
+        if isinstance(pno, int) and pno >= 0:
+            self._decode(pno * page_size // (SECTORS * SECTOR_SIZE), ((pno + 1) * page_size - 1) // (SECTORS * SECTOR_SIZE))
+        return super().get_page(pno, page_size)
+
+
+class MycronDiskette:
+    def __init__(self, fname, strict=True):
+        """With strict=False, directory entries that point outside of the disk are kept, so they can
+        be reported by check_allocation(). Reading them still fails.
+        """
         self.fname = fname
-        self.data = open(fname, 'rb').read()
-        self.disk = split_disk(self.data)
+        self.strict = strict
+        with open(fname, 'rb') as f:
+            is_scp = f.read(3) == b'SCP'
+        if is_scp:
+            with stats.timer("imd_decode"):
+                self.img = CaptureImage(fname)
+        else:
+            self.img = RawImage.from_file(fname, sectors=SECTORS, sector_size=SECTOR_SIZE)
+        assert len(self.img) == TRACKS * SECTORS * SECTOR_SIZE, f"{fname} is not a {TRACKS}x{SECTORS}x{SECTOR_SIZE} image"
         self._scan_volume_id()
-        match self.disktype:
-            case "DATA":
-                self.files = self._get_data_files()
-            case "PROG":
-                self.files = self._get_prog_files()
+        self.bad_tracks = self._read_errmap()
+        with stats.timer("directory"):
+            match self.disktype:
+                case "DATA":
+                    self.files = self._get_data_files()
+                case "PROG":
+                    self.files = self._get_prog_files()
 
     def check_errmap(self):
         # errmap is on track 0, sector 5
-        sect = self.disk[(0, 5)]
-        s = sect[:5].decode("ASCII")
+        sect = self.img.get_sector(0, 5)
+        s = bytes(sect[:5]).decode("ASCII")
         # print("Checking that ERMAP is present at sector 5")
         assert s == "ERMAP"
-        # TODO: check errmap (page 6-37 in dim-1030 docs)
+
+    def _read_errmap(self):
+        """Returns the bad tracks listed in the ERMAP (page 6-37 in dim-1030 docs).
+        Positions 7-11 and 13-17 (from 1) are the addresses (tt0ss) of up to two bad tracks,
+        blank (or anything else that isn't an address) if there are none.
+        """
+        sect = self.img.get_sector(0, 5)
+        if bytes(sect[:5]) != b"ERMAP":
+            return []
+        bad = []
+        for start in (6, 12):
+            addr = bytes(sect[start:start + 5])
+            if not (addr.isdigit() and addr[2:3] == b"0"):
+                continue
+            track = int(addr[:2])
+            if 0 < track < TRACKS:
+                bad.append(track)
+            else:
+                print(f"WARNING: bad track {addr} in ERMAP is not on the disk, ignored")
+        return bad
 
     def _scan_volume_id(self):
-        sect = self.disk[(0, 7)]
+        sect = self.img.get_sector(0, 7)
         vol1 = extract_ascii(sect, 0, 4)
         match vol1:
             case "VOL1":
@@ -224,7 +345,7 @@ class MycronDiskette:
     def _get_data_files(self):
         dl = []
         for sno in range(8, SECTORS+1):
-            sect = self.disk[(0, sno)]
+            sect = self.img.get_sector(0, sno)
             if not DataEntry.verify_data_entry(sect):
                 continue
             entry = DataEntry(sect, self)
@@ -235,7 +356,7 @@ class MycronDiskette:
     def _get_prog_files(self):
         pl = []
         for sno in range(8, SECTORS+1):
-            sect = self.disk[(0, sno)]
+            sect = self.img.get_sector(0, sno)
             entries = split_sect(sect, 16)
             # print(entries)
             for rpe in entries:
@@ -247,7 +368,7 @@ class MycronDiskette:
 
     def get_metainf(self):
         s = f"{self.fname}\n"
-        s + "\n".join([str(f) for f in self.files])
+        s += "\n".join([str(f) for f in self.files])
         if not s.endswith("\n"):
             s += "\n"
         return s
@@ -261,20 +382,99 @@ class MycronDiskette:
                 archive.add_file(file)
         return archive
 
+    def check_extent(self, track, sector, count):
+        """Raises ValueError if the extent is not on the disk (only if strict)"""
+        if self.strict:
+            self.img.check_sectors(track, sector, count)
+
+    def extents(self):
+        """Returns the allocated sectors as a list of (first linear sector, number of sectors, owner):
+        the index track, the bad tracks from the ERMAP and the files in the directory.
+        """
+        ext = [(0, SECTORS, "<index track>")]
+        ext += [(track * SECTORS, SECTORS, "<bad track>") for track in self.bad_tracks]
+        ext += [entry.extent() for entry in self.files]
+        return ext
+
+    def allocation_map(self):
+        """Returns the allocation of all the sectors of the disk (and of any extents past the end of it)
+        as a sorted list of runs (first, end, owners), where owners are the indexes in extents() of
+        the extents using the sectors first..end-1 (empty for free sectors).
+        The map is built in one sweep over the sorted start and end points of the extents.
+        """
+        events = []
+        for i, (first, count, _) in enumerate(self.extents()):
+            if count > 0:
+                events.append((first, 1, i))
+                events.append((first + count, -1, i))
+        events.sort()
+        events.append((TRACKS * SECTORS, 0, None))    # so free space at the end of the disk is included
+
+        runs = []
+        active = set()
+        pos = 0
+        for at, change, i in events:
+            if at > pos:
+                owners = tuple(sorted(active))
+                if runs and runs[-1][1] == pos and runs[-1][2] == owners:
+                    runs[-1] = (runs[-1][0], at, owners)
+                else:
+                    runs.append((pos, at, owners))
+                pos = at
+            if change > 0:
+                active.add(i)
+            elif change < 0:
+                active.discard(i)
+        return runs
+
+    def check_allocation(self):
+        """Checks the allocation map for overlapping extents and extents past the end of the disk.
+        Returns a dict with the results, see format_allocation_report().
+        """
+        ext = self.extents()
+        total = TRACKS * SECTORS
+        report = {"sectors": total, "used": 0, "free": 0, "free_runs": [], "bad_tracks": self.bad_tracks,
+                  "overlaps": [], "past_end": []}
+        for first, end, owners in self.allocation_map():
+            if first >= total:
+                break
+            end = min(end, total)
+            if not owners:
+                report["free"] += end - first
+                report["free_runs"].append((first, end))
+                continue
+            report["used"] += end - first
+            if len(owners) > 1:
+                report["overlaps"].append((first, end, [ext[i][2] for i in owners]))
+        for first, count, owner in ext:
+            if first + count > total:
+                report["past_end"].append((first, count, owner))
+        return report
+
+    @staticmethod
+    def allocation_ok(report):
+        return not (report["overlaps"] or report["past_end"])
+
+    @staticmethod
+    def format_allocation_report(report):
+        """Returns the results of check_allocation() as lines of text"""
+        lines = [f"sectors {report['sectors']}, used {report['used']}, free {report['free']}, "
+                 f"bad tracks {' '.join(str(t) for t in report['bad_tracks']) or 'none'}"]
+        if report["free_runs"]:
+            lines.append("free: " + " ".join(f"{_ts(first)}-{_ts(end - 1)}" for first, end in report["free_runs"]))
+        for first, end, owners in report["overlaps"]:
+            lines.append(f"sectors {_ts(first)}-{_ts(end - 1)} used by: {', '.join(owners)}")
+        for first, count, owner in report["past_end"]:
+            lines.append(f"{owner} at {_ts(first)} + {count} sectors runs past track {TRACKS - 1}")
+        return lines
+
+    def read_extent(self, track, sector, count):
+        """Returns count sectors starting at track/sector as one contiguous memoryview"""
+        return self.img.get_sectors(track, sector, count)
+
     def get_sectors(self, start_track, start_sector, end_track, end_sector):
         """Returns the sectors from (including) start track/sector up to (but not including) end track and sector.
-        Returned as a dict with key = (trk,sect)
+        Returned as one contiguous memoryview (empty if the end is before the start).
         """
-        trk = start_track
-        sct = start_sector
-        sectors = {}
-        while trk <= end_track:
-            if trk == end_track and sct >= end_sector:
-                break
-            k = (trk, sct)
-            sectors[k] = self.disk[k]
-            sct += 1
-            if sct > SECTORS:
-                trk += 1
-                sct = 1
-        return sectors
+        count = sect_index(end_track, end_sector) - sect_index(start_track, start_sector)
+        return self.read_extent(start_track, start_sector, max(count, 0))
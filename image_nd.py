@@ -13,15 +13,17 @@ NB:
 - the offsets in the figures in the ND documents are probably octal * word_size (2 bytes)
 
 
-TODO:
-- check for more than one user (to be on the safe side).
-- check for files from more than one user.
+Files from all users are extracted, with a directory per user if there is more than one.
 """
 
+import sys
 import argparse
 import struct
+import threading
 import imd_common
-from image_common import Archive, File
+import stats
+from common import write_hexdump
+from image_common import Archive, File, RawImage, register_probe
 
 verbose = False
 
@@ -63,7 +65,7 @@ def decode_ptr(ptr):
 
 def decode_name(raw_str):
     """returns a string that does not include the ending ' and 0s"""
-    s = raw_str.decode('ascii').strip()   # does not remove NUL bytes
+    s = bytes(raw_str).decode('ascii').strip()   # does not remove NUL bytes
     s = s.split("\x00", 1)[0]
     s = s.split("'")[0]
     return s.rstrip()
@@ -100,12 +102,28 @@ def decode_user_entry_info(word):
 
 
 class Entry:
-    def __init__(self, data, img):
+    """Base class for the 64 byte (32 word) entries in the object and user files.
+    Subclasses define FORMAT (a precompiled struct.Struct for the entry) and _decode(fields).
+    """
+    __slots__ = ('data', 'img', 'info', 'hu', 'is_used')
+    SIZE = 64
+    FORMAT = None
+
+    def __init__(self, data, img, fields=None):
         self.data = data
         self.img = img
-        self._decode()
+        self._decode(fields if fields is not None else self.FORMAT.unpack_from(data))
         self.is_used = self.hu
 
+    @classmethod
+    def decode_page(cls, page, img):
+        """Decodes the used entries in a page (32 entries).
+        The used flag (bit 15 of the first word) is checked on the raw page, so nothing is
+        decoded or created for unused entries.
+        """
+        return [cls(page[offs:offs + cls.SIZE], img, cls.FORMAT.unpack_from(page, offs))
+                for offs in range(0, len(page), cls.SIZE) if page[offs] & 0x80]
+
     def dump(self):
         print(self.dump_str())
 
@@ -124,45 +142,43 @@ class ObjectEntry(Entry):
 
     # http://heim.bitraf.no/tingo/files/nd/ND-60.052.04_NORD_File_System_April_1977_ocr.pdf
     # page 39
-    # NB: offsets in the documentation are in octal form!
-    def _decode(self):
+    # NB: offsets in the documentation are in octal form! (octal word offsets below)
+    #  0       entry info
+    #  1 - 10  object name (16 bytes)
+    # 11 - 12  type (4 chars)
+    # 13, 14   pointers to next and previous version
+    # 15       access bits
+    # 16 - 23  file type, device number, user index (reserved by), object index, currently open, total opens
+    # 24 - 31  dates: created, last opened for read, last opened for write (double words)
+    # 32 - 37  pages in file, max byte pointer, file pointer (double words)
+    FORMAT = struct.Struct(">H16s4sHHHHHHHHHLLLLLL")
+    __slots__ = ('hw', 'hr', 'hm', 'name', 'otype', 'ptr_next_ver', 'ptr_prev_ver',
+                 'access_bits', 'access_owner', 'access_friend', 'access_public',
+                 'ftype', 'device_num', 'usr_idx_res', 'obj_idx', 'cur_open', 'tot_open',
+                 'date_create', 'date_last_rd', 'date_last_wr',
+                 'pages_in_file', 'max_byte_pointer', 'file_pointer', 'user')
+
+    def _decode(self, fields):
         # entry info (first 2 bytes)
         # u - entry used
         # m - file modiefied (opened for write), or magnetic tape file
         # r - file reserved
         # w - currently opened for write
-        self.info = self._get_words(0)
+        (self.info, name, otype,
+         self.ptr_next_ver, self.ptr_prev_ver,        # pointers to version
+         self.access_bits,                            # 3 fields (public, friend, owner), each field ix DCAWR
+         self.ftype, self.device_num, self.usr_idx_res, self.obj_idx, self.cur_open, self.tot_open,
+         self.date_create,
+         self.date_last_rd,                           # last data opened for read
+         self.date_last_wr,                           # last data opened for write
+         self.pages_in_file, self.max_byte_pointer, self.file_pointer) = fields
         self.hu, self.hw, self.hr, self.hm = decode_obj_entry_info(self.info)
-
-        # TODO: stop decoding if self.hu is false.
-
-        # 16 bytes object name
-        # TODO: trim 0s from the end of the file.
-        self.name = decode_name(self._raw_words(0o1, 0o10))
-
-        # type - 4 chars
-        self.otype = decode_name(self._raw_words(0o11, 0o12))
-
-        # pointers to version
-        self.ptr_next_ver = self._get_words(0o13)
-        self.ptr_prev_ver = self._get_words(0o14)
-
-        self.access_bits = self._get_words(0o15)   # 3 fields (public, friend, owner), each field ix DCAWR
+        self.name = decode_name(name)
+        self.otype = decode_name(otype)
         self.access_owner = self.access_bits & 0x1f
         self.access_friend = (self.access_bits >> 5) & 0x1f
         self.access_public = (self.access_bits >> 10) & 0x1f
-        self.ftype       = self._get_words(0o16)
-        self.device_num  = self._get_words(0o17)
-        self.usr_idx_res = self._get_words(0o20)
-        self.obj_idx     = self._get_words(0o21)
-        self.cur_open    = self._get_words(0o22)
-        self.tot_open    = self._get_words(0o23)
-        self.date_create = self._get_words(0o24, 0o25)
-        self.date_last_rd = self._get_words(0o26, 0o27) # last data opened for read
-        self.date_last_wr = self._get_words(0o30, 0o31) # last data opened for write
-        self.pages_in_file = self._get_words(0o32, 0o33) # bts_to_word2(self.data[52:56])
-        self.max_byte_pointer = self._get_words(0o34, 0o35) # bts_to_word2(self.data[56:60])
-        self.file_pointer = self._get_words(0o36, 0o37) # bts_to_word2(self.data[60:64])
+        self.user = None       # user name, filled in by NDImage
 
     def dump_str(self):
         s = "\n".join([
@@ -185,68 +201,70 @@ class ObjectEntry(Entry):
     def get_file_info(self):
         # if not indexed, continuous file.
         # if indexed, defined by an 1K index block, which contains pointers to the 1K data page of the file
-        subidx, idx, fptr = decode_ptr(self.file_pointer)
-        if subidx:
-            raise NotImplementedError(f"{self.name=} {subidx=} {idx=}  {fptr=}")
-        pg = self.img.get_page(fptr)
+        # if subindexed, the subindex block contains pointers to index blocks.
         s = ""
-        if idx:
-            for i in range(self.pages_in_file):
-                fpg = bts_to_word2(pg[i*4:(i+1)*4])
-                # print(hex(fpg), self.img.get_page(fpg)[:32])
-                if verbose:
-                    # print(f"{i:2} {fpg:#02x}", self.img.get_page(fpg))
-                    s += f"{i:2} {fpg:#02x} {self.img.get_page(fpg)}\n"
+        if verbose and decode_ptr(self.file_pointer)[:2] != (False, False):
+            for i, fpg in enumerate(self.img.resolve_pages(self.file_pointer, self.pages_in_file)):
+                s += f"{i:2} {fpg:#02x} {bytes(self.img.get_page(fpg))}\n"
         return s
 
-    def get_file(self):
-        # if not indexed, continuous file.
-        # if indexed, defined by an 1K index block, which contains pointers to the 1K data page of the file
+    def file_size(self):
+        # Assuming max_byte_pointer is the actual end of the file
+        return min(self.pages_in_file * NDImage.PAGE_SIZE, self.max_byte_pointer + 1)
+
+    def iter_file(self):
+        """Yields the file page by page, with the last page trimmed at the end of the file.
+        Pages after the end of the file are not read.
+        """
         subidx, idx, fptr = decode_ptr(self.file_pointer)
-        if subidx:
-            raise NotImplementedError(f"{self.name=} {subidx=} {idx=}  {fptr=}")
-        pg = self.img.get_page(fptr)
-        data = b''
-        if idx:
-            if self.pages_in_file  * 4 > NDImage.PAGE_SIZE:
-                raise ValueError(f"indexes are 2 words. An index page can only have 512 indexes, but {self.pages_in_file=}")
-            for i in range(self.pages_in_file):
-                fpg = bts_to_word2(pg[i*4:(i+1)*4])
-                # print(hex(fpg), self.img.get_page(fpg)[:32])
-                data += self.img.get_page(fpg)
-                if verbose:
-                    print(f"{i:2} {fpg:#02x}", self.img.get_page(fpg))
-        else:
+        if not (subidx or idx):
             # Continuous files on the disk
             print("NB: continuous file on disk", self.name, self.otype)
-            for i in range(self.pages_in_file):
-                data += self.img.get_page(fptr + i)
-
-        print(self.name, self.otype, len(data), self.max_byte_pointer)
-        if len(data) < self.max_byte_pointer:
+        pages = self.img.resolve_pages(self.file_pointer, self.pages_in_file)
+
+        remaining = self.file_size()
+        for i, fpg in enumerate(pages):
+            if remaining <= 0:
+                break
+            if fpg == 0:
+                print(f"WARNING: page {i} of {self.name}.{self.otype} is not allocated, using 0s")
+                page = bytes(NDImage.PAGE_SIZE)
+            else:
+                page = self.img.get_page(fpg)
+            if verbose and (subidx or idx):
+                print(f"{i:2} {fpg:#02x}", bytes(page))
+            yield page[:remaining]
+            remaining -= len(page)
+
+        length = len(pages) * NDImage.PAGE_SIZE
+        print(self.name, self.otype, length, self.max_byte_pointer)
+        if length < self.max_byte_pointer:
             print("WARNING: length of data shouldn't be lower than the max_byte_pointer", subidx, idx, fptr)
-            imd_common.hexdump_data(pg)
-        if 1:
-            return data[:self.max_byte_pointer+1]   # Assuming this is the actual end of the file
-        return data
+            imd_common.hexdump_data(self.img.get_page(fptr))
+
+    def get_file(self):
+        return b''.join(self.iter_file())
 
 
 class UserEntry(Entry):
-    def _decode(self):
-        self.info = self._get_words(0, 0)
+    # octal word offsets:
+    # 0       entry info
+    # 1 - 10  user name (16 bytes)
+    # 11      password
+    # 12 - 21 date created, date last entered, pages reserved, pages used (double words)
+    # 22 - 24 user index, mail flag, default file access
+    # TODO:
+    # friend table which should be from 0o30 to 0o37
+    FORMAT = struct.Struct(">H16s2sLLLLHHH22x")
+    __slots__ = ('hf', 'enter_count', 'user_name', 'password', 'date_created', 'date_last_entered',
+                 'no_pages_reserved', 'no_pages_used', 'user_index', 'mail_flag', 'user_default_file_access')
+
+    def _decode(self, fields):
+        (self.info, user_name, self.password,
+         self.date_created, self.date_last_entered, self.no_pages_reserved, self.no_pages_used,
+         self.user_index, self.mail_flag, self.user_default_file_access) = fields
         self.hu, self.hf, self.enter_count  = decode_user_entry_info(self.info)
-        # print(self.hu, self.hf, self.enter_count)
-        self.user_name = decode_name(self.data[2:18])       # octal dword 1-10
-        self.password = self.data[18:20]                    # octal dword 11
-        self.date_created      = self._get_words(0o12, 0o13)
-        self.date_last_entered = self._get_words(0o14, 0o15)
-        self.no_pages_reserved = self._get_words(0o16, 0o17)
-        self.no_pages_used     = self._get_words(0o20, 0o21)
-        self.user_index        = self._get_words(0o22, 0o22)
-        self.mail_flag         = self._get_words(0o23, 0o23)
-        self.user_default_file_access = self._get_words(0o24, 0o24)
-        # TODO:
-        # friend table which should be from 0o30 to 0o37
+        self.user_name = decode_name(user_name)
 
     def dump_str(self):
         s = "\n".join([
@@ -268,32 +286,114 @@ class UserEntry(Entry):
 class NDImage:
     PAGE_SIZE = 2048   # 1024 words of 16 bits
     PTR_SIZE  = 4      # 4 bytes
+    INDEX_ENTRIES = PAGE_SIZE // PTR_SIZE     # pointers in an index page
+    INDEX_FORMAT = struct.Struct(f">{INDEX_ENTRIES}L")
+    OBJ_PAGES_PER_USER = 8   # 8 * 32 = 256 objects per user
 
-    def __init__(self, fname):
+    def __init__(self, fname, verify_heads=True, lazy=False):
         self.fname = fname
+        self.verify_heads = verify_heads
+        self._lazy_capture = None    # the capture while it is read lazily
+        self._fallback_lock = threading.Lock()
         # TODO: should perhaps check a bit more robustly for IMD files.
-        self.data = open(fname, 'rb').read()
-        if self.data[:4] == b'IMD ':
-            im = imd_common.read_imd(fname)
-            self.data = imd_common.get_full_img_ss(im)
-        self._extract_hdr()
-        self.usr_file()
-        self.obj_file()
+        if imd_common.is_imd(fname) or imd_common.is_scp(fname):
+            # Only head 0 is used, pages are read from the IMD file (or SCP flux capture) on demand.
+            # verify_heads=False skips checking that head 1 is a copy of head 0 (trusted captures).
+            # lazy=True (for listing) only indexes the IMD file as far as the pages that are read,
+            # and doesn't check the heads. See _lazy_fallback() for captures that can't be read that way.
+            with stats.timer("imd_decode"):
+                if lazy:
+                    imd = self._lazy_capture = imd_common.open_capture(fname, lazy=True)
+                    self.img = imd_common.LinearImage(imd, imd_common.iter_head0_tracks(imd))
+                else:
+                    self.img = self._read_capture()
+        else:
+            self.img = RawImage.from_file(fname)
+        self._index_pages = {}     # page number -> decoded index page
+        with stats.timer("directory"):
+            self._extract_hdr()
+            self.usr_file()
+            self.obj_file()
+
+    def _read_capture(self):
+        ss = imd_common.conv_ds_to_ss(imd_common.open_capture(self.fname), verify=self.verify_heads)
+        return imd_common.LinearImage(ss)
+
+    def _lazy_fallback(self):
+        """Called when reading a lazily opened capture failed. If it's because the head 0 tracks are
+        out of order in the file, the whole capture is read (as without lazy) and True is returned.
+        """
+        imd, self._lazy_capture = self._lazy_capture, None
+        if imd is None:
+            return False
+        cylinders = [track.cylinder for track in imd.tracks if track.head == 0]
+        if cylinders == sorted(set(cylinders)):
+            return False
+        print(f"WARNING: {self.fname}: tracks are out of order, reading all of the image")
+        with stats.timer("imd_decode"):
+            self.img = self._read_capture()
+        return True
+
+    def _from_img(self, func):
+        """Returns func(), retrying once if a lazily read capture has to be read in full"""
+        img = self.img
+        try:
+            return func()
+        except ValueError:
+            with self._fallback_lock:
+                # Another thread may have switched to the full capture already
+                if self.img is img and not self._lazy_fallback():
+                    raise
+            return func()
 
     def get_page(self, pno):
-        if not isinstance(pno, int) or pno < 0:
-            raise ValueError(f"Invalid page number: {pno!r}")
-        page = self.data[pno * self.PAGE_SIZE: (pno+1) * self.PAGE_SIZE]
-        if len(page) != self.PAGE_SIZE:
-            raise ValueError(f"Page is len {len(page)} - should be {PAGE_SIZE}")
-        return page
+        stats.count("pages_read")
+        return self._from_img(lambda: self.img.get_page(pno, self.PAGE_SIZE))
+
+    def n_pages(self):
+        """The number of pages in the image"""
+        return self._from_img(lambda: len(self.img)) // self.PAGE_SIZE
+
+    def get_index(self, pno):
+        """Returns the page pointers in an index page.
+        Index pages are only read and decoded once, even if many files use them.
+        """
+        index = self._index_pages.get(pno)
+        if index is None:
+            index = self._index_pages[pno] = self.INDEX_FORMAT.unpack(self.get_page(pno))
+        return index
+
+    def resolve_page(self, ptr, lpno):
+        """Returns the page number of logical page lpno of a file, given the file pointer.
+        Unallocated pages in (sub)indexed files are returned as 0.
+        """
+        subidx, idx, pno = decode_ptr(ptr)
+        if subidx and idx:
+            raise ValueError(f"Invalid file pointer {ptr:#x} (both subindexed and indexed)")
+        if subidx:
+            if lpno >= self.INDEX_ENTRIES ** 2:
+                raise ValueError(f"Page {lpno} is beyond the end of a subindexed file")
+            ipno = self.get_index(pno)[lpno // self.INDEX_ENTRIES]
+            return self.get_index(ipno)[lpno % self.INDEX_ENTRIES] if ipno else 0
+        if idx:
+            if lpno >= self.INDEX_ENTRIES:
+                raise ValueError(f"indexes are 2 words. An index page can only have {self.INDEX_ENTRIES} indexes, but asked for {lpno}")
+            return self.get_index(pno)[lpno]
+        return pno + lpno
+
+    def resolve_pages(self, ptr, n_pages):
+        """Returns the page numbers of the first n_pages pages of a file"""
+        subidx, idx, pno = decode_ptr(ptr)
+        if not (subidx or idx):
+            return range(pno, pno + n_pages)
+        return [self.resolve_page(ptr, lpno) for lpno in range(n_pages)]
 
     def _extract_hdr(self):
         # Strictly speaking, this is the master block.
         # The start of the master block can contain bootable code.
         # The last bit of it contains the directory entry for the floppy
-        self.hdr = self.data[0x7e0:0x800]
-        self.name = self.hdr[:16].decode('ascii')
+        self.hdr = self.get_page(0)[0x7e0:0x800]
+        self.name = bytes(self.hdr[:16]).decode('ascii')
         self.obj_file_ptr = bts_to_ptr(self.hdr[16:20])
         self.usr_file_ptr = bts_to_ptr(self.hdr[20:24])
         self.bit_file_ptr = bts_to_ptr(self.hdr[24:28])
@@ -301,37 +401,28 @@ class NDImage:
 
     def _obj_file_pg(self, pg_no):
         # print(f"--- decoding obj file entry from page {pg_no:#x}")
-        page = self.get_page(pg_no)
-        objs = []
-        for i in range(32):
-            obj = ObjectEntry(page[64 * i:64 * (i + 1)], self)
-            if obj.is_used:
-                # obj.dump()
-                objs.append(obj)
-        return objs
+        return ObjectEntry.decode_page(self.get_page(pg_no), self)
+
+    def _user_obj_pages(self, user_index):
+        """Returns the object file pages with the objects of a user"""
+        # Theres up to 8 * 32 = 256 files per user on a disk, in 8 consecutive (logical) pages
+        # of the object file.
+        # http://heim.bitraf.no/tingo/files/nd/ND-60.122.02_NORD_File_System_-_System_Documentation_January_1980_ocr.pdf
+        # page 21
+        first = user_index * self.OBJ_PAGES_PER_USER
+        pages = (self.resolve_page(self.obj_file_ptr, lpno) for lpno in range(first, first + self.OBJ_PAGES_PER_USER))
+        return [pg_no for pg_no in pages if pg_no > 0]
 
     def obj_file(self):
+        """Finds the objects of all users"""
         self.objects = []
-        subidx, idx, ptr = decode_ptr(self.obj_file_ptr)
-        if subidx:
-            print("CANNOT PARSE SUBIDX YET")
-            return
-
-        if idx:
-            pg_idx = self.get_page(ptr)
-            # imd_common.hexdump_data(pg_idx)
-            # print(pg_idx)
-            # Theres up to 8 * 32 = 256 files per user on a disk
-            # http://heim.bitraf.no/tingo/files/nd/ND-60.122.02_NORD_File_System_-_System_Documentation_January_1980_ocr.pdf
-            # page 21
-            # NB: this assumes there is only one user!
-            for i in range(8):
-                pg_no = bts_to_word2(pg_idx[i*4:(i+1)*4])
-                if pg_no > 0:
-                    self.objects.extend(self._obj_file_pg(pg_no))
-        else:
-            self.objects.extend(self._obj_file_pg(ptr))
-
+        # If there is no user file, assume that there is a single user
+        users = [(u.user_index, u.user_name) for u in self.users] or [(0, None)]
+        for user_index, user_name in users:
+            for pg_no in self._user_obj_pages(user_index):
+                for obj in self._obj_file_pg(pg_no):
+                    obj.user = user_name
+                    self.objects.append(obj)
 
     # ND-60.122.02 page 2-8
     # The user file contains information on all the users of the medium.
@@ -341,26 +432,15 @@ class NDImage:
     # directory entry points to an inciex block. The index block contains up to 8 double
     # word pointers to user file pages. This structure is illustrated in Figure 2.10.
     def _usr_file_pg(self, pg_no):
-        page = self.get_page(pg_no)
-        objs = []
-        for i in range(32):
-            obj = UserEntry(page[64 * i:64 * (i + 1)], self)
-            if obj.is_used:
-                # obj.dump()
-                objs.append(obj)
-        return objs
+        return UserEntry.decode_page(self.get_page(pg_no), self)
 
     def usr_file(self):
         self.users = []
         subidx, idx, ptr = decode_ptr(self.usr_file_ptr)
-        if subidx:
-            raise NotImplementedError("CANNOT PARSE SUBIDX YET")
-
         # print(f"User file {subidx} {idx} {ptr:#x}")
-        if idx:
-            pg_idx = self.get_page(ptr)
-            for i in range(8):
-                pg_no = bts_to_word2(pg_idx[i*4:(i+1)*4])
+        if subidx or idx:
+            for lpno in range(8):
+                pg_no = self.resolve_page(self.usr_file_ptr, lpno)
                 if pg_no > 0:
                     # print(f" --- valid usr pg {pg_no:#x}")
                     self.users.extend(self._usr_file_pg(pg_no))
@@ -376,8 +456,13 @@ class NDImage:
     def get_archive(self):
         archive = Archive(self.fname)
         archive.add_file(File(".meta", self.get_metainf().encode("ascii")))
+        # Use a directory per user if there are files from more than one user
+        multi_user = len({obj.user for obj in self.objects}) > 1
         for obj in self.objects:
-            archive.add_file(File(f"{obj.name}.{obj.otype}", obj.get_file()))
+            path = f"{obj.name}.{obj.otype}"
+            if multi_user:
+                path = f"{obj.user}/{path}"
+            archive.add_file(File(path, obj.iter_file, size=obj.file_size()))
         return archive
 
 
@@ -387,15 +472,45 @@ class NDImage:
         for v in self.obj_file_ptr, self.usr_file_ptr, self.bit_file_ptr, self.not_res_pgs:
             print(f"{v:#10x}", decode_ptr(v))
 
-    def print_pages(self):
+    def print_pages(self, out=None):
         """ND format diskettes ignore tracks/sectors etc and instead focus on the logical pages.
-        This dumps data per page.
+        This dumps data per page to out (default sys.stdout).
         """
-        n_pages = len(self.data) // self.PAGE_SIZE
-        for pno in range(n_pages):
+        if out is None:
+            out = sys.stdout
+        for pno in range(self.n_pages()):
             page = self.get_page(pno)
-            print(f"--- {self.fname} page {pno:3} {pno:#3x}")
-            imd_common.hexdump_data(page)
+            out.write(f"--- {self.fname} page {pno:3} {pno:#3x}\n")
+            write_hexdump(page, out)
+
+
+def probe(img):
+    """Checks that there is something that looks like a master block at 0x7e0, in a raw
+    or IMD image: a printable directory name and sane object/user/bit file pointers.
+    """
+    im = imd_common.probe_imd(img)
+    if im is not None:
+        try:
+            hdr = imd_common.LinearImage(imd_common.conv_ds_to_ss(im, verify=False)).read(0x7e0, 32)
+        except (KeyError, ValueError, AssertionError):
+            return False
+        n_pages = None    # unknown without indexing the whole image
+    else:
+        hdr = img.read(0x7e0, 32)
+        n_pages = img.size // NDImage.PAGE_SIZE
+    if len(hdr) != 32:
+        return False
+    name = hdr[:16].split(b"\x00")[0].split(b"'")[0]
+    if not name.strip() or not all(0x20 <= c < 0x7f for c in name):
+        return False
+    for ptr in struct.unpack(">LLL", hdr[16:28]):
+        subidx, idx, pno = decode_ptr(ptr)
+        if (subidx and idx) or pno == 0 or (n_pages is not None and pno >= n_pages):
+            return False
+    return True
+
+
+register_probe("nd", probe)
 
 
 def main():
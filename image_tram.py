@@ -1,69 +1,71 @@
 #!/usr/bin/env python
 
-from sqlite3 import NotSupportedError
 import sys
 import argparse
-import imd
+import functools
 import imd_common
-from image_common import Archive, File
+import stats
+from image_common import Archive, File, register_probe
 
 
 class TramDisk:
-    def __init__(self, fname):
+    # Layout of the header (sector 1-5 of track 0)
+    HDR_SECTORS = 5
+    IDX_START = 156          # start of the document number of each track (it's in the second sector of track 0 with some offset)
+    IDX_TRACKS = 76          # tracks 1..76
+    FN_START = 3*128-3       # start of the file names
+    FN_SIZE = 12
+    LINE_SIZE = 79           # line number + 78 chars of text
+
+    def __init__(self, fname, lazy=False):
         self.fname = fname
-        d = imd.Disk.from_file(fname)
-        self.disk = d
-        self.track_data = dict()
-        for t in d.tracks:
-            k = (t.cylinder, t.head)
-            if k in self.track_data:
-                raise ValueError(f"Failed... {k} already exists in track_data")
-            self.track_data[(t.cylinder, t.head)] = t
-
-        self.sectors = dict()
-        for t in d.tracks:
-            for sno, s in zip(t.sector_numbering_map, t.sector_data_records):
-                k = (t.cylinder, t.head, sno)
-                if k in self.sectors:
-                    raise ValueError(f"Duplicate sector {k}")
-                self.sectors[k] = s
-
+        # Only indexes the file, sectors are read when they are used.
+        # With lazy=True (for listing), only the tracks that are used are indexed.
+        # SCP flux captures are decoded a track at a time, when they are used.
+        with stats.timer("imd_decode"):
+            self.img = imd_common.open_capture(fname, lazy=lazy)
         d = self.get_sector_data(0, 1)
         assert d[:5].decode('ascii') == "*TRAM"
+        self._index = None         # (filenames, doc no -> tracks), see _doc_index()
+        self._track_lines = {}     # track -> sorted lines
 
     def get_sector_data(self, tno, sno):
         """Fetches a sector from the IMD image.
         Expands compressed sectors.
         """
-        t = self.track_data[(tno, 0)]
-        ssize = t.sector_size
-        s = self.sectors[(tno, 0, sno)]
-        d = s.data
-        if len(d) == 0:
-            raise NotSupportedError(f"Data size of 0 : {tno=} {sno=} {d=}")
-        if len(d) == 1:
-            return d * ssize
-        return d
+        return self.img.get_sector(tno, 0, sno)
 
     def get_raw_hdr(self):
         """Assuming that sector 1-5 are header sectors - returns a raw byte string
         of these sectors"""
-        return b''.join([self.get_sector_data(0, i) for i in range(1, 6)])
+        return b''.join([self.get_sector_data(0, i) for i in range(1, self.HDR_SECTORS + 1)])
+
+    def _doc_index(self):
+        """Returns (filenames, dict of doc number -> tracks).
+        Built from the header the first time it is needed.
+        """
+        if self._index is None:
+            with stats.timer("directory"):
+                hdr = self.get_raw_hdr()
+                # For simplicity, assume that filenames start at the end of sector 3,
+                # so offset 3*128-3 and that the last entry is followed with a 0xff
+                # marker (unused file entries start with 0xff)
+                fnames = []
+                offs = self.FN_START
+                while hdr[offs] != 0xff:
+                    fnames.append(hdr[offs:offs + self.FN_SIZE].decode('ascii').strip())
+                    offs += self.FN_SIZE
+                # The header has a region of 76 bytes indicating which document number
+                # is stored in the corresponding tracks (1..76). Unused tracks are stored as 0xff
+                doc_tracks = {}
+                for tno, doc_no in enumerate(hdr[self.IDX_START:self.IDX_START + self.IDX_TRACKS], start=1):
+                    doc_tracks.setdefault(doc_no, []).append(tno)
+                self._index = (fnames, doc_tracks)
+        return self._index
 
     def filenames(self):
         """Returns a list of filenames on the image"""
-        hdr = self.get_raw_hdr()
-        # For simplicity, assume that filenames start at the end of sector 3,
-        # so offset 3*128-3 and that the last entry is followed with a 0xff
-        # marker (unused file entries start with 0xff)
-        fn_start = hdr[3*128-3:]
-        fnames = []
-        while fn_start[0] != 0xff:
-            fn = fn_start[:12].decode('ascii').strip()
-            fnames.append(fn)
-            # print(fn)
-            fn_start = fn_start[12:]
-        return fnames
+        return list(self._doc_index()[0])
 
     def doc_chunks(self, track):
         """Returns (line num, 78 char text) for each line in the track.
@@ -73,19 +75,9 @@ class TramDisk:
         """
         # A text track starts sith 0x01 at the first sectors.
         # It looks like text comes in chunks of a number/index plus 78 bytes.
-        data = b''
-        cur_sec = 0
-        while True:
-            if len(data) < 79:
-                # Add next sector
-                cur_sec += 1
-                if cur_sec > 26:
-                    return
-                data += self.get_sector_data(track, cur_sec)
-            num = data[0]
-            txt = data[1:79]
-            data = data[79:]
-            yield (num, txt)
+        data = b''.join([self.get_sector_data(track, sno) for sno in range(1, 27)])
+        for offs in range(0, len(data) - self.LINE_SIZE + 1, self.LINE_SIZE):
+            yield (data[offs], data[offs + 1:offs + self.LINE_SIZE])
 
     def track_lines(self, track):
         """Returns the sorted lines in a document, skipping
@@ -93,33 +85,29 @@ class TramDisk:
           one is old data that is not overwritten)
         - lines with line numbers >= 0xe5 (assuming they are unused). These
           _may_ have other formatting information in them (TODO).
+        The lines of a track are only decoded once.
         """
-        lines = {}
+        lines = self._track_lines.get(track)
+        if lines is not None:
+            return lines
+        found = {}
         for lno, chunk in self.doc_chunks(track):
             if lno >= 0xe5:
                 # print(f"Skipping eot {lno:#02x}", chunk)
                 continue
-            if lno in lines:
+            if lno in found:
                 if 0:
                     print("Skipping duplicate line", lno)
-                    print("   - ", lines[lno])
+                    print("   - ", found[lno])
                     print("     ", chunk)
                 continue
-            lines[lno] = chunk
-        return [(lno, lines[lno]) for lno in sorted(lines.keys())]
+            found[lno] = chunk
+        lines = self._track_lines[track] = sorted(found.items())
+        return lines
 
     def doc_get_track_numbers(self, doc_no):
-        """The header has a region of 76 bytes indicating which document number
-        the are stored in the corresponding tracks (1..76)
-        Unused tracks are stored as 0xff
-        This function returns the tracks corresponding to document doc_no.
-        """
-        IDX_START=156    # start of document indexes (it's in the second sector of track 0 with some offset)
-        hdr = self.get_raw_hdr()
-        indexes = [int(x) for x in hdr[IDX_START: IDX_START+76]]
-        tracks = [tno for tno, idx in enumerate(indexes, start=1) if idx == doc_no]
-        # print(tracks, indexes)
-        return tracks
+        """Returns the tracks (1..76) with document doc_no, according to the header"""
+        return list(self._doc_index()[1].get(doc_no, []))
 
     def doc_get_raw_lines(self, doc_no):
         track_nums = self.doc_get_track_numbers(doc_no)
@@ -129,6 +117,14 @@ class TramDisk:
             # TODO: maybe insert a page break between tracks? (depends on interpretation)
             yield bytes(' ' * 78, encoding='ascii')
 
+    def doc_iter_file(self, doc_no):
+        """Yields the document as newline separated lines"""
+        sep = b''
+        for line in self.doc_get_raw_lines(doc_no):
+            yield sep
+            yield line
+            sep = b'\n'
+
     def get_metainf(self):
         s = f"{self.fname}\n"
         return s + "\n".join(self.filenames())
@@ -138,11 +134,24 @@ class TramDisk:
         archive.add_file(File(".meta", self.get_metainf().encode("ascii")))
         for fno, fname in enumerate(self.filenames()):
             print(" -- ", fname)
-            data = b'\n'.join(self.doc_get_raw_lines(fno))
-            archive.add_file(File(fname, data))
+            archive.add_file(File(fname, functools.partial(self.doc_iter_file, fno)))
         return archive
 
 
+def probe(img):
+    """IMD image with *TRAM at the start of sector 00.01"""
+    im = imd_common.probe_imd(img)
+    if im is None:
+        return False
+    try:
+        return im.get_sector(0, 0, 1)[:5] == b'*TRAM'
+    except (KeyError, ValueError):
+        return False
+
+
+register_probe("tram", probe)
+
+
 def tram_raw_dump_documents(fname):
     tdisk = TramDisk(fname)
     fnames = tdisk.filenames()
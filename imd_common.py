@@ -1,6 +1,12 @@
 #!/usr/bin/env python3
 
-import copy
+import mmap
+import time
+import bisect
+import threading
+import functools
+import stats
+from array import array
 from collections import defaultdict
 import imd
 from common import hexdump_data
@@ -10,25 +16,356 @@ def read_imd(fname):
     return imd.Disk.from_file(fname)
 
 
-def same_data(head0, head1):
-    if len(head0.sector_data_records) != len(head1.sector_data_records):
-        print("lens different", len(head0.sector_data_records), (head1.sector_data_records))
+def is_imd(fname):
+    with open(fname, 'rb') as f:
+        return f.read(4) == b'IMD '
+
+
+def is_scp(fname):
+    """True for SCP flux captures (see scp.py)"""
+    with open(fname, 'rb') as f:
+        return f.read(3) == b'SCP'
+
+
+def open_capture(fname, lazy=False):
+    """Opens an IMD image or an SCP flux capture, which have the same sector interface.
+    SCP captures are decoded one track at a time, when the track is first used.
+    """
+    if is_scp(fname):
+        import scp       # needs numpy, which is only needed for flux captures
+        return scp.SCPFile(fname)
+    return IMDFile(fname, lazy=lazy)
+
+
+def probe_imd(probe, nbytes=0x4000, max_tracks=2):
+    """Returns an IMDFile indexing the first nbytes (and at most max_tracks tracks) of a probed
+    file (see image_common.ProbeInput), or None if it isn't an IMD file. SCP flux captures give
+    an SCPFile, that only decodes the first max_tracks tracks (when they are used).
+    This is enough to get at track 0 without reading the image.
+    The result is kept on the probe, so several format probes can share it.
+    """
+    if probe.magic != b'IMD ' and probe.magic[:3] != b'SCP':
+        return None
+    if 'imd' not in probe.cache:
+        try:
+            if probe.magic[:3] == b'SCP':
+                import scp
+                probe.cache['imd'] = scp.SCPFile(probe.fname, max_tracks=max_tracks)
+            else:
+                probe.cache['imd'] = IMDFile(probe.fname, buf=probe.read(0, nbytes), partial=True, max_tracks=max_tracks)
+        except (ValueError, NotImplementedError, ImportError):
+            probe.cache['imd'] = None
+    return probe.cache['imd']
+
+
+@functools.lru_cache(maxsize=64)
+def expand_sector(fill, sector_size):
+    """Compressed sectors are stored as a single byte. Most of them are the same few
+    fill values (0xe5, 0x00, ...), so the expanded sectors are cached and shared."""
+    return bytes([fill]) * sector_size
+
+
+class IMDTrack:
+    """Track header from an IMD file together with the file offsets of its sector records.
+    Sector data is not decoded here, see IMDFile.get_sector()
+    """
+    __slots__ = ('mode', 'cylinder', 'head', 'sector_size', 'sector_numbering_map',
+                 'sector_cylinder_map', 'sector_head_map', 'offsets', 'start', 'end')
+
+    def __init__(self, mode, cylinder, head, sector_size, nmap, cmap, hmap, offsets, start, end):
+        self.mode = mode
+        self.cylinder = cylinder
+        self.head = head
+        self.sector_size = sector_size
+        self.sector_numbering_map = nmap
+        self.sector_cylinder_map = cmap
+        self.sector_head_map = hmap
+        self.offsets = offsets
+        self.start = start      # file offset of the track header
+        self.end = end          # file offset after the last sector record
+
+    @property
+    def sector_count(self):
+        return len(self.sector_numbering_map)
+
+
+class IMDFile:
+    """Random access reader for IMD images.
+
+    The file is memory mapped and scanned once to find the track headers and the
+    offset of each sector record. Sectors are only read (and expanded, if compressed)
+    when they are asked for with get_sector().
+    See http://dunfield.classiccmp.org/img/index.htm for the IMD format.
+
+    buf can be given instead of mapping the file. With partial=True, buf can be the
+    start of an IMD file, and only the tracks that are complete in buf are indexed.
+    max_tracks stops the scan after that many tracks.
+    With lazy=True, the file is only scanned as far as needed to find the sectors (or
+    tracks) that are asked for, so errors further out in the file are not found up front.
+    """
+    def __init__(self, fname, buf=None, partial=False, max_tracks=None, lazy=False):
+        self.fname = fname
+        self.partial = partial
+        self.max_tracks = max_tracks
+        if buf is None:
+            with open(fname, 'rb') as f:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.mm = buf
+        if self.mm[:4] != b'IMD ':
+            raise ValueError(f"{fname} is not an IMD file")
+        self._tracks = []
+        self.sector_index = {}    # (cylinder, head, sector) -> (track, record offset)
+        hdr_end = self.mm.find(b'\x1a')
+        if hdr_end < 0:
+            raise ValueError(f"{self.fname}: missing end of IMD comment")
+        self.header = self.mm[:hdr_end].decode('ascii', errors='replace')
+        self._pos = hdr_end + 1   # offset of the next track header, None when all tracks are indexed
+        if not lazy:
+            self._scan()
+
+    @property
+    def tracks(self):
+        """All the tracks in the file (indexing the rest of the file if needed)"""
+        self._scan()
+        return self._tracks
+
+    def iter_tracks(self):
+        """Yields the tracks in file order, only indexing the file as far as the caller gets"""
+        i = 0
+        while i < len(self._tracks) or self._scan_track() is not None:
+            yield self._tracks[i]
+            i += 1
+
+    def _scan(self):
+        while self._scan_track() is not None:
+            pass
+
+    def _scan_track(self):
+        """Indexes the next track in the file. Returns the track, or None at the end of the file."""
+        mm = self.mm
+        pos = self._pos
+        if pos is None or pos >= len(mm) or len(self._tracks) == self.max_tracks:
+            self._pos = None
+            return None
+        if pos + 5 > len(mm):
+            if self.partial:
+                self._pos = None
+                return None
+            raise ValueError(f"{self.fname}: truncated track header at {pos:#x}")
+        start = pos
+        mode, cyl, head, count, size_code = mm[pos:pos + 5]
+        pos += 5
+        if size_code == 0xff:
+            raise NotImplementedError(f"{self.fname}: variable sector size tracks are not supported ({cyl}.{head})")
+        nmap = mm[pos:pos + count]
+        pos += count
+        cmap = hmap = None
+        if head & 0x80:
+            cmap = mm[pos:pos + count]
+            pos += count
+        if head & 0x40:
+            hmap = mm[pos:pos + count]
+            pos += count
+        head &= 0x0f
+        sector_size = 128 << size_code
+        offsets = array('L')
+        for _ in range(count):
+            if pos >= len(mm):
+                pos += 1      # truncated, handled below
+                break
+            offsets.append(pos)
+            rtype = mm[pos]
+            if rtype == 0:
+                pos += 1
+            elif rtype > 8:
+                raise ValueError(f"{self.fname}: unknown sector record type {rtype} at {pos:#x}")
+            elif rtype % 2 == 0:
+                pos += 2          # compressed
+            else:
+                pos += 1 + sector_size
+        if pos > len(mm):
+            if self.partial:
+                self._pos = None
+                return None
+            raise ValueError(f"{self.fname}: track {cyl}.{head} is truncated")
+        track = IMDTrack(mode, cyl, head, sector_size, nmap, cmap, hmap, offsets, start, pos)
+        for sno, offs in zip(nmap, offsets):
+            k = (cyl, head, sno)
+            if k in self.sector_index:
+                raise ValueError(f"Duplicate sector {k}")
+            self.sector_index[k] = (track, offs)
+        self._tracks.append(track)
+        self._pos = pos
+        return track
+
+    def _lookup(self, cyl, head, sno):
+        """Returns (track, record offset) of a sector, indexing more of the file if needed"""
+        k = (cyl, head, sno)
+        while k not in self.sector_index and self._scan_track() is not None:
+            pass
+        return self.sector_index[k]
+
+    def record_type(self, cyl, head, sno):
+        _, offs = self._lookup(cyl, head, sno)
+        return self.mm[offs]
+
+    def has_error(self, cyl, head, sno):
+        return self.record_type(cyl, head, sno) >= 5
+
+    def get_sector(self, cyl, head, sno):
+        """Returns the data of a sector. Compressed sectors are expanded."""
+        track, offs = self._lookup(cyl, head, sno)
+        rtype = self.mm[offs]
+        if rtype == 0:
+            raise ValueError(f"Sector {cyl}.{head}.{sno} is unavailable")
+        stats.count("sectors_read")
+        if rtype % 2 == 0:
+            stats.count("bytes_expanded", track.sector_size)
+            return expand_sector(self.mm[offs + 1], track.sector_size)
+        return self.mm[offs + 1:offs + 1 + track.sector_size]
+
+
+class LinearImage:
+    """Presents the sectors of an IMDFile (or a single sided view of one) as a flat raw
+    image, in the same order as get_raw_img() (tracks in order, sectors by sector number).
+    Nothing is read until a range of the image is asked for.
+    tracks can be given as an iterable of the tracks to use (default imd_file.tracks). It is
+    only consumed as far as the image is read, see iter_head0_tracks().
+    Reads are serialized with a lock, as the index (and the capture's own caches) is built while
+    pages are read from several threads (f.ex. Archive.write_to_zip()).
+    """
+    def __init__(self, imd_file, tracks=None):
+        self.imd_file = imd_file
+        self._tracks = iter(imd_file.tracks if tracks is None else tracks)
+        self.sectors = []     # (cylinder, head, sector)
+        self.starts = []      # linear offset of each sector
+        self.size = 0         # size of the part of the image that is indexed so far
+        self._complete = False
+        self._lock = threading.Lock()
+
+    def _index_to(self, offset):
+        """Indexes tracks until offset is in the indexed part of the image, or all tracks are indexed"""
+        while not self._complete and offset >= self.size:
+            track = next(self._tracks, None)
+            if track is None:
+                self._complete = True
+                break
+            for sno in sorted(track.sector_numbering_map):
+                self.sectors.append((track.cylinder, track.head, sno))
+                self.starts.append(self.size)
+                self.size += track.sector_size
+
+    def __len__(self):
+        with self._lock:
+            self._index_to(float('inf'))
+            return self.size
+
+    def read(self, offset, length):
+        """Returns length bytes from offset (or less at the end of the image)"""
+        with self._lock:
+            return self._read(offset, length)
+
+    def _read(self, offset, length):
+        self._index_to(offset + length - 1)
+        end = min(offset + length, self.size)
+        idx = bisect.bisect_right(self.starts, offset) - 1
+        parts = []
+        while offset < end:
+            start = self.starts[idx]
+            sect = self.imd_file.get_sector(*self.sectors[idx])
+            parts.append(sect[offset - start:end - start])
+            offset = start + len(sect)
+            idx += 1
+        return b''.join(parts)
+
+    def get_page(self, pno, page_size):
+        if not isinstance(pno, int) or pno < 0:
+            raise ValueError(f"Invalid page number: {pno!r}")
+        page = self.read(pno * page_size, page_size)
+        if len(page) != page_size:
+            raise ValueError(f"Page is len {len(page)} - should be {page_size}")
+        return page
+
+
+def _track_buffer(track, img):
+    """Returns the sector data of a track as one contiguous buffer.
+    For IMDFile tracks this is the raw sector records straight from the file.
+    """
+    if isinstance(track, IMDTrack):
+        return img.mm[track.offsets[0]:track.end] if track.offsets else b''
+    return b''.join(sdr.data for sdr in track.sector_data_records)
+
+
+def same_heads(img, tracks_h0, tracks_h1):
+    """True if the head 1 tracks contain the same data as the corresponding head 0 tracks.
+    All tracks are compared in one go.
+    """
+    pairs = [(tracks_h0[tno], track1) for tno, track1 in sorted(tracks_h1.items())]
+    if any(t0.sector_count != t1.sector_count for t0, t1 in pairs):
+        print("lens different")
         return False
+    if b''.join(_track_buffer(t0, img) for t0, _ in pairs) == b''.join(_track_buffer(t1, img) for _, t1 in pairs):
+        return True
+    if isinstance(img, IMDFile):
+        # The records may be encoded differently (compressed or not) while holding the same data.
+        for t0, t1 in pairs:
+            for s0, s1 in zip(t0.sector_numbering_map, t1.sector_numbering_map):
+                try:
+                    same = img.get_sector(t0.cylinder, 0, s0) == img.get_sector(t1.cylinder, 1, s1)
+                except (ValueError, KeyError):
+                    # An unavailable sector on either head, so they can't be the same
+                    same = False
+                if not same:
+                    print("DATA DIFFERENT")
+                    return False
+        return True
+    print("DATA DIFFERENT")
+    return False
+
+
+class SingleSidedView:
+    """Head 0 view of an imd.Disk or IMDFile. Only the track list differs from the
+    underlying image, everything else is looked up there. No sector data is copied.
+    """
+    def __init__(self, img, tracks):
+        self.img = img
+        self.tracks = tracks
 
-    for s0, s1 in zip(head0.sector_data_records, head1.sector_data_records):
-        if s0.data != s1.data:
-            print("DATA DIFFERENT")
-            return False
+    def __getattr__(self, name):
+        return getattr(self.img, name)
 
-    return True
+    def to_bytes(self):
+        """Returns the view as an IMD image: the header and comment of the underlying image,
+        followed by the head 0 tracks"""
+        if isinstance(self.img, IMDFile):
+            # The track records are copied as they are in the file
+            mm = self.img.mm
+            return bytes(mm[:mm.find(b'\x1a') + 1]) + b''.join(bytes(mm[t.start:t.end]) for t in self.tracks)
+        full = self.img.to_bytes()
+        return full[:full.find(b'\x1a') + 1] + b''.join(t.to_bytes() for t in self.tracks)
 
 
-def conv_ds_to_ss(img):
-    """Converts a DS Disk image to SS. 
-    NB: this also verifies that head 1 (if present) is a copy of head 0.
-    And that head 1 data (if present) is identical to head 0 data.
+def iter_head0_tracks(img):
+    """Yields the head 0 tracks of an IMDFile, in file order, while the file is indexed.
+    This is the lazy version of conv_ds_to_ss() (for listing): head 1 is not compared
+    with head 0, and the head 0 tracks have to be in cylinder order in the file.
+    """
+    prev = -1
+    for track in img.iter_tracks():
+        if track.head != 0:
+            continue
+        if track.cylinder <= prev:
+            raise ValueError(f"{img.fname}: track {track.cylinder} comes after track {prev}, can't be read lazily")
+        prev = track.cylinder
+        yield track
+
+
+def conv_ds_to_ss(img, verify=True):
+    """Converts a DS Disk image to SS.
+    Returns a view of img with only the head 0 tracks, sorted by cylinder.
+    If verify is set, this also verifies that head 1 (if present) is a copy of head 0.
     This happens if an imd has been created from a single sided drive that was
-    scanned a double sided drive.
+    scanned a double sided drive. Trusted captures can skip the check with verify=False.
     """
     # make sure all tracks are extracted and sorted by track/head
     tracks_h0 = {track.cylinder : track for track in img.tracks if track.head == 0}
@@ -36,15 +373,34 @@ def conv_ds_to_ss(img):
     assert len(tracks_h0) + len(tracks_h1) == len(img.tracks)
 
     assert all(tno in tracks_h0 for tno in tracks_h1.keys()), f"all head 1 should have a corresponding head 0 track"
-    for tno, track1 in tracks_h1.items():
-        track0 = tracks_h0[tno]
-        assert same_data(track0, track1)
+    if verify and tracks_h1:
+        assert same_heads(img, tracks_h0, tracks_h1), "head 1 data differs from head 0"
 
     ntracks = sorted(tracks_h0.values(), key = lambda track: track.cylinder)
-    # A little naughty, but it _should_ work
-    im2 = copy.deepcopy(img)
-    im2.tracks = ntracks
-    return im2
+    return SingleSidedView(img, ntracks)
+
+
+def encode_imd(tracks, comment="", date=None):
+    """Encodes an IMD image.
+    tracks is a list of (mode, cylinder, head, sector_size, sectors), where sectors is a list of
+    (sector number, data, has_error). data is None for unavailable sectors.
+    Sectors filled with a single value are stored compressed.
+    """
+    date = date or time.localtime()
+    out = bytearray(time.strftime("IMD 1.18: %d/%m/%Y %H:%M:%S\r\n", date).encode('ascii'))
+    out += comment.encode('ascii') + b'\x1a'
+    for mode, cyl, head, sector_size, sectors in tracks:
+        out += bytes([mode, cyl, head, len(sectors), (sector_size // 128).bit_length() - 1])
+        out += bytes(sno for sno, _, _ in sectors)
+        for sno, data, has_error in sectors:
+            if data is None:
+                out.append(0)
+            elif data.count(data[0]) == len(data):
+                out += bytes([6 if has_error else 2, data[0]])
+            else:
+                out.append(5 if has_error else 1)
+                out += data
+    return bytes(out)
 
 
 def get_sectors_in_order(track):
@@ -76,7 +432,8 @@ def get_raw_img(im):
     
 
 def get_full_img_ss(im):
-    s_im = conv_ds_to_ss(im)
-    return get_raw_img(s_im)
+    with stats.timer("imd_decode"):
+        s_im = conv_ds_to_ss(im)
+        return get_raw_img(s_im)
 
 
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+"""
+Merges several captures (IMD images or SCP flux captures) of the same diskette into one image.
+
+Marginal diskettes come back with different bad sectors on each read. The sectors of all the
+captures are matched up by (cylinder, head, sector), and for each sector
+- a copy without errors is used. If the error-free copies differ, the most common one is used.
+- if all copies have errors, each byte is voted on: it gets the value most of the copies have.
+  All such sectors are voted on at once, on arrays of the stacked copies.
+- sectors that none of the captures have are unavailable in IMD output (zero filled in raw output).
+  Tracks are padded to the most sectors seen on any track of the same format, as a track decoded
+  from flux only lists the sectors up to the last one found.
+The result is written as an IMD or raw image, with a report of where each sector came from.
+
+  imd_merge.py read1.imd read2.imd read3.scp -o merged.imd --report merged.json
+"""
+
+import argparse
+import json
+import sys
+from collections import Counter, defaultdict
+import numpy as np
+import imd_common
+
+
+def load_captures(fnames):
+    """Returns (copies, geometry), where copies is a dict of (cylinder, head, sector) ->
+    list of (capture number, data, has error) and geometry is (cylinder, head) -> (mode, sector size).
+    copies has all the sectors of the format on every track, see pad_tracks().
+    """
+    copies = defaultdict(list)
+    geometry = {}
+    for cno, fname in enumerate(fnames):
+        capture = imd_common.open_capture(fname)
+        for track in capture.tracks:
+            cyl, head = track.cylinder, track.head
+            mode, sector_size = geometry.setdefault((cyl, head), (track.mode, track.sector_size))
+            for sno in track.sector_numbering_map:
+                cps = copies[(cyl, head, sno)]      # listed even if it's unavailable
+                try:
+                    data = bytes(capture.get_sector(cyl, head, sno))
+                except ValueError:
+                    continue      # unavailable in this capture
+                if len(data) != sector_size:
+                    print(f"WARNING: {fname}: sector {cyl:02}.{head}.{sno:02} has {len(data)} bytes, "
+                          f"expected {sector_size}, not used")
+                    continue
+                cps.append((cno, data, capture.has_error(cyl, head, sno)))
+    pad_tracks(copies, geometry)
+    return copies, geometry
+
+
+def pad_tracks(copies, geometry):
+    """Adds the sectors missing from the end (or the middle) of tracks to copies (with no copies).
+    Each track gets the range of sector numbers seen on any track with the same mode and sector size.
+    """
+    numbers = defaultdict(set)      # (mode, sector size) -> sector numbers
+    for cyl, head, sno in copies:
+        numbers[geometry[(cyl, head)]].add(sno)
+    for (cyl, head), fmt in geometry.items():
+        snos = numbers.get(fmt)
+        if not snos:
+            continue
+        for sno in range(min(snos), max(snos) + 1):
+            copies[(cyl, head, sno)]      # listed, but unavailable
+
+
+def vote(stack):
+    """Bytewise majority vote over stack, an array of (sectors, copies, sector size).
+    Returns (the voted sectors, number of bytes the copies didn't agree on for each sector).
+    Ties go to the first copy.
+    """
+    n_copies = stack.shape[1]
+    agree = np.empty(stack.shape, dtype=np.int32)
+    for i in range(n_copies):
+        agree[:, i, :] = (stack == stack[:, i:i + 1, :]).sum(axis=1)
+    winner = agree.argmax(axis=1)
+    voted = np.take_along_axis(stack, winner[:, None, :], axis=1)[:, 0, :]
+    disputed = (stack != voted[:, None, :]).any(axis=1).sum(axis=1)
+    return voted, disputed
+
+
+def merge(copies, fnames):
+    """Returns a dict of (cylinder, head, sector) -> (data, has error, provenance).
+    data is None for sectors no capture has.
+    """
+    merged = {}
+    to_vote = defaultdict(list)     # (number of copies, sector size) -> sectors
+    for key, cps in copies.items():
+        good = [(cno, data) for cno, data, err in cps if not err]
+        if good:
+            counts = Counter(data for _, data in good)
+            data = counts.most_common(1)[0][0]
+            cno = next(cno for cno, d in good if d == data)
+            prov = {"source": "good copy", "capture": fnames[cno], "copies": len(cps), "good_copies": len(good)}
+            if len(counts) > 1:
+                prov["good_copies_differ"] = True
+            merged[key] = (data, False, prov)
+        elif len(cps) == 1:
+            cno, data, _ = cps[0]
+            merged[key] = (data, True, {"source": "bad copy", "capture": fnames[cno], "copies": 1})
+        elif cps:
+            to_vote[(len(cps), len(cps[0][1]))].append(key)
+        else:
+            merged[key] = (None, False, {"source": "missing", "copies": 0})
+
+    for (n_copies, size), keys in to_vote.items():
+        stack = np.frombuffer(b''.join(data for key in keys for _, data, _ in copies[key]), dtype=np.uint8)
+        voted, disputed = vote(stack.reshape(len(keys), n_copies, size))
+        for key, data, n_disputed in zip(keys, voted, disputed):
+            # The CRC can't be checked, so a voted sector is still marked as having errors
+            merged[key] = (data.tobytes(), True, {"source": "vote", "copies": n_copies,
+                                                  "disputed_bytes": int(n_disputed)})
+    return merged
+
+
+def _tracks(merged):
+    """Returns {(cylinder, head): sorted sector numbers}"""
+    tracks = defaultdict(list)
+    for cyl, head, sno in sorted(merged):
+        tracks[(cyl, head)].append(sno)
+    return tracks
+
+
+def to_imd(merged, geometry, comment=""):
+    tracks = []
+    for (cyl, head), snos in sorted(_tracks(merged).items()):
+        mode, sector_size = geometry[(cyl, head)]
+        sectors = [(sno, *merged[(cyl, head, sno)][:2]) for sno in snos]
+        tracks.append((mode, cyl, head, sector_size, sectors))
+    return imd_common.encode_imd(tracks, comment)
+
+
+def to_raw(merged, geometry, double_sided=False):
+    """Returns the merged sectors as a raw image (only head 0 unless double_sided), tracks in order,
+    sectors by sector number. Missing sectors are filled with zeros.
+    """
+    out = bytearray()
+    for (cyl, head), snos in sorted(_tracks(merged).items()):
+        if head != 0 and not double_sided:
+            continue
+        sector_size = geometry[(cyl, head)][1]
+        for sno in snos:
+            data = merged[(cyl, head, sno)][0]
+            out += data if data is not None else bytes(sector_size)
+    return bytes(out)
+
+
+def report(merged, fnames):
+    sectors = [{"sector": f"{cyl:02}.{head}.{sno:02}", **prov} for (cyl, head, sno), (_, _, prov) in sorted(merged.items())]
+    return {
+        "captures": fnames,
+        "summary": dict(Counter(s["source"] for s in sectors)),
+        "sectors": sectors,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Merges several captures of a diskette, using the good copy of each sector "
+                                             "or voting on the bytes of the bad ones")
+    ap.add_argument("captures", nargs='+', help="IMD or SCP captures of the same diskette")
+    ap.add_argument("-o", "--out", help="merged IMD image")
+    ap.add_argument("--raw", help="merged raw image (head 0, unless -ds)")
+    ap.add_argument("-ds", action="store_true", help="include head 1 in the raw image")
+    ap.add_argument("--report", help="write where each sector came from as json to this file ('-' for stdout)")
+    args = ap.parse_args()
+
+    copies, geometry = load_captures(args.captures)
+    merged = merge(copies, args.captures)
+    rep = report(merged, args.captures)
+
+    for s in rep["sectors"]:
+        if s["source"] != "good copy" or s.get("good_copies_differ"):
+            details = ", ".join(f"{k} {v}" for k, v in s.items() if k not in ("sector", "source"))
+            print(f"{s['sector']} {s['source']}: {details}")
+    print(f"{len(merged)} sectors: " + ", ".join(f"{n} {source}" for source, n in rep["summary"].items()))
+
+    if args.out:
+        with open(args.out, 'wb') as f:
+            f.write(to_imd(merged, geometry, f"merged from {', '.join(args.captures)}"))
+    if args.raw:
+        with open(args.raw, 'wb') as f:
+            f.write(to_raw(merged, geometry, args.ds))
+    if args.report == '-':
+        json.dump(rep, sys.stdout, indent=2)
+        print()
+    elif args.report:
+        with open(args.report, 'w') as f:
+            json.dump(rep, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+"""
+Allocation consistency check for ND images (dump.py --check).
+
+The bit file has one bit per page on the medium, most significant bit first, set if the page
+is reserved. The check compares it with the pages that are actually referenced from the master
+block (the object, user and bit files, and the data and index pages of every object) and reports
+- pages that are used by a file, but marked as free in the bit file
+- pages claimed by more than one file (cross-linked)
+- pages marked as reserved, that nothing refers to (orphaned)
+- references to pages beyond the end of the image
+All pages are checked in one go with numpy, so this is fast enough to run on a whole collection.
+"""
+
+import numpy as np
+from image_nd import NDImage, decode_ptr
+
+PAGE_BITS = NDImage.PAGE_SIZE * 8
+
+
+def _index(img, pno, n_pages):
+    """The pointers in index page pno (none if the page is outside of the image)"""
+    if pno >= n_pages:
+        return np.zeros(0, dtype=np.uint32)
+    return np.frombuffer(img.get_page(int(pno)), dtype='>u4').astype(np.uint32)
+
+
+def file_pages(img, ptr, n_pages, n_file_pages=None):
+    """Returns the pages used by a file, the index pages followed by the (allocated) data pages.
+    n_pages is the number of pages in the image. n_file_pages limits the pages of (sub)indexed
+    files, None includes all the pages in the index. Contiguous files need n_file_pages.
+    """
+    subidx, idx, pno = decode_ptr(ptr)
+    if not (subidx or idx):
+        return np.arange(pno, pno + n_file_pages, dtype=np.uint32)
+    if idx:
+        data = _index(img, pno, n_pages)[:n_file_pages]
+        index = np.array([pno], dtype=np.uint32)
+    else:
+        top = _index(img, pno, n_pages)
+        if n_file_pages is not None:
+            top = top[:-(-n_file_pages // NDImage.INDEX_ENTRIES)]
+        parts = []
+        for i in np.flatnonzero(top):
+            sub = _index(img, top[i], n_pages)
+            if n_file_pages is not None:
+                sub = sub[:max(n_file_pages - i * NDImage.INDEX_ENTRIES, 0)]
+            parts.append(sub)
+        data = np.concatenate(parts) if parts else np.zeros(0, dtype=np.uint32)
+        index = np.concatenate([[pno], top[top != 0]]).astype(np.uint32)
+    return np.concatenate([index, data[data != 0]])
+
+
+def read_bitmap(img, n_pages):
+    """Returns the bit file as an array with one element (0 or 1) per page"""
+    n_bit_pages = -(-n_pages // PAGE_BITS)
+    pages = file_pages(img, img.bit_file_ptr, n_pages, n_bit_pages)
+    subidx, idx, _ = decode_ptr(img.bit_file_ptr)
+    if subidx or idx:
+        # Skip the index pages
+        pages = pages[len(pages) - min(n_bit_pages, len(pages)):]
+    data = b''.join(bytes(img.get_page(int(p))) for p in pages if p < n_pages)
+    bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8))[:n_pages]
+    if len(bits) < n_pages:
+        # Pages missing from the bit file count as free
+        bits = np.concatenate([bits, np.zeros(n_pages - len(bits), dtype=np.uint8)])
+    return bits
+
+
+def _owners(img, n_pages):
+    """Returns a list of (owner name, pages) for everything that is referenced from the master block"""
+    subidx, idx, _ = decode_ptr(img.obj_file_ptr)
+    n_users = max([u.user_index for u in img.users], default=0) + 1
+    owners = [
+        ("<master block>", np.zeros(1, dtype=np.uint32)),
+        ("<object file>", file_pages(img, img.obj_file_ptr, n_pages,
+                                     None if subidx or idx else n_users * NDImage.OBJ_PAGES_PER_USER)),
+        ("<user file>", file_pages(img, img.usr_file_ptr, n_pages, None if any(decode_ptr(img.usr_file_ptr)[:2]) else 1)),
+        ("<bit file>", file_pages(img, img.bit_file_ptr, n_pages, -(-n_pages // PAGE_BITS))),
+    ]
+    for obj in img.objects:
+        name = f"{obj.name}.{obj.otype}" if obj.user is None else f"{obj.user}/{obj.name}.{obj.otype}"
+        owners.append((name, file_pages(img, obj.file_pointer, n_pages, obj.pages_in_file)))
+    return owners
+
+
+def check(img):
+    """Checks the allocation of an NDImage. Returns a dict with the results, see format_report()."""
+    n_pages = img.n_pages()
+    owners = _owners(img, n_pages)
+    pages = np.concatenate([p for _, p in owners]).astype(np.int64)
+    owner_ids = np.repeat(np.arange(len(owners)), [len(p) for _, p in owners])
+
+    outside = pages >= n_pages
+    beyond = [(owners[o][0], int(p)) for o, p in zip(owner_ids[outside], pages[outside])]
+    pages, owner_ids = pages[~outside], owner_ids[~outside]
+
+    refcount = np.bincount(pages, minlength=n_pages)
+    bits = read_bitmap(img, n_pages)
+    used_free = np.flatnonzero((refcount > 0) & (bits == 0))
+    multi = np.flatnonzero(refcount > 1)
+    orphans = np.flatnonzero((bits == 1) & (refcount == 0))
+
+    claimed = {}
+    mask = np.isin(pages, multi)
+    for p, o in zip(pages[mask], owner_ids[mask]):
+        claimed.setdefault(int(p), []).append(owners[o][0])
+
+    return {
+        "pages": n_pages,
+        "referenced": int(np.count_nonzero(refcount)),
+        "reserved": int(bits.sum()),
+        "not_res_pgs": img.not_res_pgs,
+        "used_but_free": used_free.tolist(),
+        "multiply_claimed": claimed,
+        "reserved_unreferenced": orphans.tolist(),
+        "beyond_image": beyond,
+    }
+
+
+def is_ok(report):
+    return not (report["used_but_free"] or report["multiply_claimed"] or report["reserved_unreferenced"]
+                or report["beyond_image"])
+
+
+def _ranges(pages):
+    """Formats a sorted list of page numbers as ranges, f.ex. 0x10-0x1f 0x30"""
+    out = []
+    start = prev = None
+    for p in pages + [None]:
+        if p is not None and prev is not None and p == prev + 1:
+            prev = p
+            continue
+        if start is not None:
+            out.append(f"{start:#x}" if start == prev else f"{start:#x}-{prev:#x}")
+        start = prev = p
+    return " ".join(out)
+
+
+def format_report(report):
+    """Returns the check results as lines of text"""
+    lines = [f"pages {report['pages']}, referenced {report['referenced']}, reserved in bit file {report['reserved']}, "
+             f"free in bit file {report['pages'] - report['reserved']} (master block says {report['not_res_pgs']})"]
+    if report["used_but_free"]:
+        lines.append(f"used but marked free: {_ranges(report['used_but_free'])}")
+    for page, names in sorted(report["multiply_claimed"].items()):
+        lines.append(f"page {page:#x} claimed by: {', '.join(names)}")
+    if report["reserved_unreferenced"]:
+        lines.append(f"reserved but unreferenced: {_ranges(report['reserved_unreferenced'])}")
+    for name, page in report["beyond_image"]:
+        lines.append(f"page {page:#x} of {name} is beyond the end of the image")
+    return lines
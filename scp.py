@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+"""
+Reads SuperCard Pro (SCP) flux captures, f.ex. from greaseweazle, and decodes the sectors
+directly, without converting the capture to IMD first.
+
+FM (Mycron and TRAM single density) and MFM (ND double density) are supported. The flux
+transitions of a revolution are turned into a stream of bit cells, the address and data marks
+are searched for in all of it at once, and the ID and data fields are checked with the
+CRC-CCITT the controller uses. All revolutions in the capture are decoded, and the first good
+copy of each sector is used.
+
+SCPFile has the same sector interface as imd_common.IMDFile (tracks, iter_tracks(), get_sector()),
+so it can be used wherever an IMD image can (see imd_common.open_capture()).
+
+See https://www.cbmstuff.com/downloads/scp/scp_image_specs.txt for the file format.
+
+  scp.py capture.scp                 # list the decoded tracks
+  scp.py capture.scp -o disk.imd     # convert to IMD
+"""
+
+import argparse
+import binascii
+import mmap
+import struct
+import numpy as np
+import imd_common
+import stats
+
+HEADER = struct.Struct("<3sBBBBBBBBBL")
+TRACK_TABLE = struct.Struct("<168L")
+REVOLUTION = struct.Struct("<LLL")    # index time, number of flux values, offset from the track header
+
+# Bit cell length (ns) and IMD mode of 8" diskettes
+CELL_NS = {"fm": 2000, "mfm": 1000}
+IMD_MODE = {"fm": 0, "mfm": 3}        # 500 kbps FM, 500 kbps MFM
+
+# Marks, as the 16 cells (clock and data bits) of the mark byte
+FM_IDAM = 0xf57e      # 0xfe with clock 0xc7
+FM_DAM = 0xf56f       # 0xfb with clock 0xc7
+FM_DDAM = 0xf56a      # 0xf8 with clock 0xc7 (deleted data)
+MFM_SYNC = 0x4489     # 0xa1 with a missing clock bit, 3 of them are followed by the mark byte
+
+ID_MARK = 0xfe
+DATA_MARKS = (0xfb, 0xf8)
+# Max number of bytes between the end of the ID field and the data mark
+GAP2_MAX = 60
+
+PLL_WINDOW = 64       # flux transitions the clock is averaged over
+
+
+def flux_times(data, ns_per_tick):
+    """Returns the intervals between the flux transitions (ns) from the 16 bit big endian flux values.
+    A 0 value means that the next interval is 65536 ticks longer.
+    """
+    vals = np.frombuffer(data, dtype='>u2').astype(np.int64)
+    zeros = vals == 0
+    if zeros.any():
+        times = np.cumsum(np.where(zeros, 0x10000, vals))[~zeros]
+        vals = np.diff(times, prepend=0)
+    return vals * ns_per_tick
+
+
+def flux_to_cells(intervals, cell_ns, window=PLL_WINDOW):
+    """Returns the bit cells (uint8 0/1) for the flux intervals.
+
+    This is a software PLL done on whole arrays: the intervals are first rounded to whole cells
+    with the nominal cell length, then the clock is taken as the average cell length over a
+    window of transitions (so it follows speed variations of the drive) and they are rounded again.
+    """
+    if len(intervals) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    n = np.maximum(np.rint(intervals / cell_ns), 1)
+    kernel = np.ones(window)
+    clock = np.convolve(intervals, kernel, 'same') / np.convolve(n, kernel, 'same')
+    n = np.maximum(np.rint(intervals / clock), 1).astype(np.int64)
+    ones = np.cumsum(n) - 1
+    cells = np.zeros(ones[-1] + 1, dtype=np.uint8)
+    cells[ones] = 1
+    return cells
+
+
+def cell_words(cells):
+    """Returns the 16 cells starting at each position as an int (the first cell is the high bit)"""
+    n = len(cells) - 15
+    if n <= 0:
+        return np.zeros(0, dtype=np.uint16)
+    words = np.zeros(n, dtype=np.uint16)
+    for i in range(16):
+        words = (words << 1) | cells[i:i + n]
+    return words
+
+
+def decode_bytes(cells, pos, n):
+    """Returns n bytes from the data cells of the cells starting at pos (None if the track ends before)"""
+    data = cells[pos + 1:pos + 1 + 16 * n:2]
+    if len(data) != 8 * n:
+        return None
+    return np.packbits(data).tobytes()
+
+
+def find_marks(cells, words, encoding):
+    """Returns the marks as (mark byte, cell position after the mark, bytes the CRC starts with)"""
+    if encoding == "fm":
+        pos = np.flatnonzero((words == FM_IDAM) | (words == FM_DAM) | (words == FM_DDAM))
+        return [(decode_bytes(cells, p, 1)[0], p + 16, b'') for p in pos]
+    sync = np.flatnonzero(words == MFM_SYNC)
+    # Three syncs in a row, then the mark byte
+    pos = sync[np.isin(sync + 16, sync) & np.isin(sync + 32, sync)] + 48
+    marks = []
+    for p in pos:
+        mark = decode_bytes(cells, p, 1)
+        if mark is not None:
+            marks.append((mark[0], p + 16, b'\xa1\xa1\xa1'))
+    return marks
+
+
+def crc_ok(data):
+    """CRC-CCITT (initial value 0xffff) over data including its CRC is 0 if it's correct"""
+    return binascii.crc_hqx(data, 0xffff) == 0
+
+
+def decode_cells(cells, encoding):
+    """Yields (cylinder, head, sector, size code, data, crc ok, deleted) for each sector found in the cells.
+    data is None if the data field is missing.
+    """
+    words = cell_words(cells)
+    marks = find_marks(cells, words, encoding)
+    for i, (mark, pos, prefix) in enumerate(marks):
+        if mark != ID_MARK:
+            continue
+        hdr = decode_bytes(cells, pos, 6)
+        if hdr is None or not crc_ok(prefix + bytes([mark]) + hdr):
+            continue      # a bad ID field can't be trusted
+        cyl, head, sno, size_code = hdr[:4]
+        size = 128 << (size_code & 7)
+        data, ok, deleted = None, False, False
+        id_end = pos + 16 * 6
+        for dmark, dpos, dprefix in marks[i + 1:i + 3]:
+            if dmark == ID_MARK or dpos > id_end + 16 * (GAP2_MAX + 4):
+                break
+            if dmark in DATA_MARKS:
+                field = decode_bytes(cells, dpos, size + 2)
+                if field is not None:
+                    data = field[:size]
+                    ok = crc_ok(dprefix + bytes([dmark]) + field)
+                    deleted = dmark == 0xf8
+                break
+        yield cyl, head, sno, size_code, data, ok, deleted
+
+
+class SCPSector:
+    __slots__ = ('data', 'error', 'deleted')
+
+    def __init__(self, data, error, deleted):
+        self.data = data
+        self.error = error
+        self.deleted = deleted
+
+
+class SCPTrack:
+    """A decoded track, with the same attributes as imd_common.IMDTrack.
+    Sectors are numbered from 1 up to the highest sector found. Sectors that weren't found
+    in any revolution are in the map, but unavailable (data is None).
+    """
+    def __init__(self, mode, cylinder, head, sector_size, sectors):
+        self.mode = mode
+        self.cylinder = cylinder
+        self.head = head
+        self.sector_size = sector_size
+        self.sectors = sectors       # sector number -> SCPSector
+        self.sector_numbering_map = list(range(1, max(sectors) + 1))
+        self.sector_cylinder_map = self.sector_head_map = None
+
+    @property
+    def sector_count(self):
+        return len(self.sector_numbering_map)
+
+    @property
+    def sector_data_records(self):
+        empty = SCPSector(b'', True, False)
+        return [self.sectors.get(sno, empty) for sno in self.sector_numbering_map]
+
+    def imd_sectors(self):
+        """The sectors as used by imd_common.encode_imd()"""
+        out = []
+        for sno in self.sector_numbering_map:
+            sect = self.sectors.get(sno)
+            out.append((sno, None, False) if sect is None or sect.data is None else (sno, sect.data, sect.error))
+        return out
+
+
+class SCPFile:
+    """Random access reader for SCP flux captures.
+
+    Tracks are decoded when they are first used. encoding is "fm" or "mfm", by default it's
+    detected from the first track with sectors (FM is tried first). cell_ns overrides the
+    nominal bit cell length (CELL_NS, for 8" drives).
+    max_tracks only uses that many of the tracks in the capture (as for IMDFile).
+    """
+    def __init__(self, fname, encoding=None, cell_ns=None, max_tracks=None):
+        self.fname = fname
+        self.encoding = encoding
+        self.cell_ns = cell_ns
+        with open(fname, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mm) < HEADER.size + TRACK_TABLE.size:
+            raise ValueError(f"{fname} is too short for an SCP file")
+        (magic, self.version, self.disk_type, self.revolutions, self.start_track, self.end_track, self.flags,
+         cell_width, self.heads, resolution, _) = HEADER.unpack_from(self.mm)
+        if magic != b'SCP':
+            raise ValueError(f"{fname} is not an SCP file")
+        if cell_width not in (0, 16):
+            raise NotImplementedError(f"{fname}: {cell_width} bit flux values are not supported")
+        self.ns_per_tick = 25 * (resolution + 1)
+        offsets = TRACK_TABLE.unpack_from(self.mm, HEADER.size)
+        # SCP track number -> offset of the track header
+        self._track_offsets = dict([(tno, offs) for tno, offs in enumerate(offsets) if offs][:max_tracks])
+        self._decoded = {}        # SCP track number -> SCPTrack (None if no sectors were found)
+        self.sector_index = {}    # (cylinder, head, sector) -> SCPTrack
+        self._by_cyl_head = {self._cyl_head(tno): tno for tno in self._track_offsets}
+
+    @staticmethod
+    def _cyl_head(tno):
+        """Cylinder and head of an SCP track number. The track table always has the heads interleaved,
+        single sided captures (the heads field) only use the even (or odd) entries.
+        """
+        return tno // 2, tno % 2
+
+    def _revolutions(self, offs):
+        """Yields the flux data of each revolution of the track at offs"""
+        if self.mm[offs:offs + 3] != b'TRK':
+            raise ValueError(f"{self.fname}: missing track header at {offs:#x}")
+        for rev in range(self.revolutions):
+            _, n_flux, data_offs = REVOLUTION.unpack_from(self.mm, offs + 4 + rev * REVOLUTION.size)
+            start = offs + data_offs
+            yield self.mm[start:start + 2 * n_flux]
+
+    def _decode_track(self, tno, offs):
+        """Decodes all the revolutions of a track. Returns an SCPTrack, or None if no sectors were found."""
+        encodings = [self.encoding] if self.encoding else list(CELL_NS)
+        cyl, head = self._cyl_head(tno)
+        for encoding in encodings:
+            sectors = {}
+            size_code = 0
+            for data in self._revolutions(offs):
+                cells = flux_to_cells(flux_times(data, self.ns_per_tick), self.cell_ns or CELL_NS[encoding])
+                for _, _, sno, sc, sdata, ok, deleted in decode_cells(cells, encoding):
+                    prev = sectors.get(sno)
+                    if prev is None or (prev.error and sdata is not None and (ok or prev.data is None)):
+                        sectors[sno] = SCPSector(sdata, not ok, deleted)
+                        size_code = sc
+                if sectors and all(not s.error for s in sectors.values()) and len(sectors) == max(sectors):
+                    break    # no need to look at more revolutions
+            if sectors:
+                self.encoding = encoding
+                stats.count("tracks_decoded")
+                return SCPTrack(IMD_MODE[encoding], cyl, head, 128 << (size_code & 7), sectors)
+        return None
+
+    def _track(self, tno, offs):
+        if tno not in self._decoded:
+            with stats.timer("flux_decode"):
+                track = self._decoded[tno] = self._decode_track(tno, offs)
+            if track is not None:
+                for sno in track.sector_numbering_map:
+                    self.sector_index[(track.cylinder, track.head, sno)] = track
+        return self._decoded[tno]
+
+    def iter_tracks(self):
+        """Yields the tracks with sectors, in file order, decoding them as the caller gets to them"""
+        for tno, offs in self._track_offsets.items():
+            track = self._track(tno, offs)
+            if track is not None:
+                yield track
+
+    @property
+    def tracks(self):
+        return list(self.iter_tracks())
+
+    def _lookup(self, cyl, head, sno):
+        tno = self._by_cyl_head.get((cyl, head))
+        if tno is not None:
+            self._track(tno, self._track_offsets[tno])
+        track = self.sector_index[(cyl, head, sno)]
+        return track, track.sectors.get(sno)
+
+    def has_error(self, cyl, head, sno):
+        _, sect = self._lookup(cyl, head, sno)
+        return sect is None or sect.error
+
+    def get_sector(self, cyl, head, sno):
+        """Returns the data of a sector (if it was found, even if it has a CRC error)"""
+        _, sect = self._lookup(cyl, head, sno)
+        if sect is None or sect.data is None:
+            raise ValueError(f"Sector {cyl}.{head}.{sno} is unavailable")
+        stats.count("sectors_read")
+        return sect.data
+
+    def to_imd(self, comment=""):
+        """Returns the decoded capture as an IMD image"""
+        tracks = [(t.mode, t.cylinder, t.head, t.sector_size, t.imd_sectors()) for t in self.tracks]
+        return imd_common.encode_imd(tracks, comment or f"{self.fname} ({self.encoding})")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Decodes the sectors of an SCP flux capture")
+    ap.add_argument("fname", help="SCP file")
+    ap.add_argument("-e", "--encoding", choices=list(CELL_NS), help="encoding (default: detect)")
+    ap.add_argument("--cell-ns", type=int, help="bit cell length in ns (default 2000 for FM, 1000 for MFM: 8\" drives)")
+    ap.add_argument("-o", "--out", help="write the sectors to this IMD file")
+    args = ap.parse_args()
+
+    scp = SCPFile(args.fname, encoding=args.encoding, cell_ns=args.cell_ns)
+    n_bad = 0
+    for track in scp.tracks:
+        bad = [sno for sno in track.sector_numbering_map if scp.has_error(track.cylinder, track.head, sno)]
+        n_bad += len(bad)
+        print(f"{track.cylinder:2}.{track.head} {track.sector_count:2} x {track.sector_size:4} {scp.encoding}"
+              + (f"  bad/missing: {' '.join(map(str, bad))}" if bad else ""))
+    print(f"{len(scp.tracks)} tracks, {n_bad} bad or missing sectors")
+    if args.out:
+        with open(args.out, 'wb') as f:
+            f.write(scp.to_imd())
+
+
+if __name__ == '__main__':
+    main()
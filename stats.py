@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+Instrumentation for finding out where the time goes when extracting images.
+
+The image classes and dump.py report into the module level timers and counters:
+  timers   - seconds spent per stage (open, directory, imd_decode, archive, assemble, write, ...)
+  counters - sectors_read, pages_read, bytes_expanded, files_written, bytes_written, ...
+Stages can be nested, the time of a stage includes the stages run inside it. f.ex. write
+includes assemble, as files are assembled lazily while they are written.
+The writers report from their worker threads, so all updates are done under a lock.
+"""
+
+import time
+import contextlib
+import threading
+from collections import defaultdict
+
+timers = defaultdict(float)      # stage -> seconds
+calls = defaultdict(int)         # stage -> number of times the stage was run
+counters = defaultdict(int)      # name -> count
+
+_END = object()
+_lock = threading.Lock()
+
+
+def reset():
+    with _lock:
+        timers.clear()
+        calls.clear()
+        counters.clear()
+
+
+def count(name, n=1):
+    with _lock:
+        counters[name] += n
+
+
+def _add_time(stage, secs, n_calls=0):
+    with _lock:
+        timers[stage] += secs
+        calls[stage] += n_calls
+
+
+@contextlib.contextmanager
+def timer(stage):
+    """Adds the time spent in the with block to stage"""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        _add_time(stage, time.perf_counter() - t0, 1)
+
+
+def timed_iter(stage, iterable):
+    """Yields from iterable, adding the time spent producing the items to stage"""
+    it = iter(iterable)
+    _add_time(stage, 0.0, 1)
+    while True:
+        t0 = time.perf_counter()
+        item = next(it, _END)
+        _add_time(stage, time.perf_counter() - t0)
+        if item is _END:
+            return
+        yield item
+
+
+def as_dict():
+    with _lock:
+        return {
+            "timers": {stage: {"seconds": secs, "calls": calls[stage]} for stage, secs in timers.items()},
+            "counters": dict(counters),
+        }
+
+
+def merge(total, part):
+    """Adds the stats in part (from as_dict()) to total, f.ex. to sum up the images in a batch"""
+    timers_total = total.setdefault("timers", {})
+    counters_total = total.setdefault("counters", {})
+    for stage, t in part["timers"].items():
+        tt = timers_total.setdefault(stage, {"seconds": 0.0, "calls": 0})
+        tt["seconds"] += t["seconds"]
+        tt["calls"] += t["calls"]
+    for name, n in part["counters"].items():
+        counters_total[name] = counters_total.get(name, 0) + n
+    return total
@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+"""
+Generators for synthetic disk images in the supported formats.
+
+The images follow the layouts described in the README files, so they can be used for
+benchmarks and for checking changes without sharing real disk images.
+
+  synth.py mycron-prog out.img --entries 152
+  synth.py mycron-data out.img --entries 19
+  synth.py tram out.imd --docs 10
+  synth.py nd out.imd --users 4 --files 40 --file-pages 600 --subindexed
+  synth.py tram out.scp --scp          # flux capture (FM, MFM for nd)
+"""
+
+import argparse
+import binascii
+import random
+import struct
+import imd_common
+from image_mycron import TRACKS, SECTORS, SECTOR_SIZE
+from image_nd import NDImage, ObjectEntry, UserEntry
+
+PAGE_SIZE = NDImage.PAGE_SIZE
+
+
+def fill(rnd, size):
+    """Some printable, not too compressible data"""
+    return bytes(rnd.randrange(0x20, 0x7f) for _ in range(size))
+
+
+def _sector_addr(idx):
+    """tt0ss address of linear sector idx, as used in the HDR1 entries"""
+    return f"{idx // SECTORS:02}0{idx % SECTORS + 1:02}"
+
+
+def mycron_prog(entries=152, seg1_sectors=6, seg2_sectors=2, seed=0):
+    """Mycron program diskette with up to 152 16 byte directory entries"""
+    rnd = random.Random(seed)
+    img = bytearray(TRACKS * SECTORS * SECTOR_SIZE)
+    img[6 * SECTOR_SIZE:6 * SECTOR_SIZE + 10] = b"PROGIBMASC"
+    dir_start = 7 * SECTOR_SIZE
+    nxt = SECTORS                 # first sector after track 0
+    for i in range(152):
+        entry = bytearray(b" " * 8 + bytes(8))
+        size = seg1_sectors + seg2_sectors
+        if i < entries and nxt + size <= TRACKS * SECTORS:
+            track, sect = nxt // SECTORS, nxt % SECTORS + 1
+            entry = f"P{i:07}".encode("ascii") + struct.pack(">BBHBHB", track, sect, 0x1000, seg1_sectors,
+                                                               0x8000, seg2_sectors)
+            img[nxt * SECTOR_SIZE:(nxt + size) * SECTOR_SIZE] = fill(rnd, size * SECTOR_SIZE)
+            nxt += size
+        img[dir_start + 16 * i:dir_start + 16 * (i + 1)] = entry
+    return bytes(img)
+
+
+def mycron_data(entries=19, file_sectors=40, seed=0):
+    """Mycron data diskette with up to 19 HDR1 entries (one per sector)"""
+    rnd = random.Random(seed)
+    img = bytearray(b"\xe5" * (TRACKS * SECTORS * SECTOR_SIZE))
+    img[4 * SECTOR_SIZE:4 * SECTOR_SIZE + 5] = b"ERMAP"
+    img[6 * SECTOR_SIZE:6 * SECTOR_SIZE + 10] = b"VOL1IBMASC"
+    nxt = SECTORS
+    for i in range(19):
+        offs = (7 + i) * SECTOR_SIZE
+        if i >= entries or nxt + file_sectors + 1 > TRACKS * SECTORS:
+            img[offs:offs + SECTOR_SIZE] = b"D" + b"\xff" * (SECTOR_SIZE - 1)
+            continue
+        text = fill(rnd, file_sectors * SECTOR_SIZE - rnd.randrange(1, SECTOR_SIZE))
+        img[nxt * SECTOR_SIZE:nxt * SECTOR_SIZE + len(text) + 1] = text + b"\x00"
+        hdr = bytearray(b" " * SECTOR_SIZE)
+        hdr[0:5] = b"HDR1 "
+        hdr[5:13] = f"D{i:07}".encode("ascii")
+        hdr[24:27] = b"080"
+        hdr[28:33] = _sector_addr(nxt).encode("ascii")                       # BOE
+        hdr[34:39] = _sector_addr(nxt + file_sectors).encode("ascii")        # EOE (one spare sector)
+        hdr[74:79] = _sector_addr(nxt + file_sectors).encode("ascii")        # EOD
+        img[offs:offs + SECTOR_SIZE] = hdr
+        nxt += file_sectors + 1
+    return bytes(img)
+
+
+def raw_to_imd(raw, sectors, sector_size, heads=1, mode=0, comment="synthetic image"):
+    """Wraps a raw image in an IMD file. With heads=2, head 1 is a copy of head 0."""
+    track_size = sectors * sector_size
+    raw = raw + bytes(-len(raw) % track_size)
+    if len(raw) // track_size > 256:
+        raise ValueError(f"{len(raw) // track_size} cylinders do not fit in an IMD file")
+    tracks = []
+    for cyl in range(len(raw) // track_size):
+        tdata = raw[cyl * track_size:(cyl + 1) * track_size]
+        secs = [(sno + 1, tdata[sno * sector_size:(sno + 1) * sector_size], False) for sno in range(sectors)]
+        for head in range(heads):
+            tracks.append((mode, cyl, head, sector_size, secs))
+    return imd_common.encode_imd(tracks, comment)
+
+
+def _fm_cells(data, clock=0xff):
+    """FM cells (clock and data bit for each bit) of data, all bytes with the same clock bits"""
+    cells = []
+    for b in data:
+        for i in range(7, -1, -1):
+            cells += (clock >> i & 1, b >> i & 1)
+    return cells
+
+
+def _mfm_cells(data, prev=0):
+    """MFM cells of data. prev is the last data bit before data."""
+    cells = []
+    for b in data:
+        for i in range(7, -1, -1):
+            bit = b >> i & 1
+            cells += (int(not (prev or bit)), bit)
+            prev = bit
+    return cells
+
+
+def _crc(data):
+    return binascii.crc_hqx(data, 0xffff).to_bytes(2, 'big')
+
+
+def encode_track(cyl, head, sectors, encoding):
+    """Bit cells of a formatted IBM track (FM as on 3740 diskettes, or MFM) with the given sectors,
+    a list of (sector number, data)
+    """
+    if encoding == "fm":
+        def mark(b):
+            return _fm_cells([b], clock=0xc7)
+        cells = _fm_cells(b"\xff" * 40 + bytes(6)) + _fm_cells(b"\xfc", clock=0xd7) + _fm_cells(b"\xff" * 26)
+        gap2, gap3, sync, prefix, byte_cells = 11, 27, 6, b'', _fm_cells
+    else:
+        def mark(b):
+            return [int(c) for c in f"{0x4489:016b}"] * 3 + _mfm_cells([b], prev=1)
+        cells = _mfm_cells(b"\x4e" * 80)
+        gap2, gap3, sync, prefix, byte_cells = 22, 54, 12, b"\xa1\xa1\xa1", _mfm_cells
+    for sno, data in sectors:
+        size_code = (len(data) // 128).bit_length() - 1
+        idf = bytes([cyl, head, sno, size_code])
+        cells += byte_cells(bytes(sync)) + mark(0xfe) + byte_cells(idf + _crc(prefix + b"\xfe" + idf))
+        cells += byte_cells(b"\xff" * gap2 if encoding == "fm" else b"\x4e" * gap2)
+        cells += byte_cells(bytes(sync)) + mark(0xfb) + byte_cells(data + _crc(prefix + b"\xfb" + data))
+        cells += byte_cells(b"\xff" * gap3 if encoding == "fm" else b"\x4e" * gap3)
+    return cells + byte_cells(b"\xff" * 40 if encoding == "fm" else b"\x4e" * 40)
+
+
+def cells_to_flux(cells, cell_ns, rnd, jitter=0.05, ns_per_tick=25):
+    """SCP flux values (ticks between the transitions) for the cells, with some timing jitter"""
+    flux = []
+    prev = 0
+    for pos, c in enumerate(cells):
+        if c:
+            ticks = round((pos + 1 - prev) * cell_ns * (1 + rnd.uniform(-jitter, jitter)) / ns_per_tick)
+            flux.append(ticks)
+            prev = pos + 1
+    return flux
+
+
+def raw_to_scp(raw, sectors, sector_size, encoding="fm", heads=1, revolutions=1, seed=0):
+    """Encodes a raw image as an SCP flux capture of an 8" diskette. With heads=2, head 1 is a copy of head 0."""
+    import scp
+    rnd = random.Random(seed)
+    track_size = sectors * sector_size
+    raw = raw + bytes(-len(raw) % track_size)
+    table = [0] * 168
+    body = bytearray()
+    data_start = scp.HEADER.size + scp.TRACK_TABLE.size
+    for cyl in range(len(raw) // track_size):
+        tdata = raw[cyl * track_size:(cyl + 1) * track_size]
+        secs = [(sno + 1, tdata[sno * sector_size:(sno + 1) * sector_size]) for sno in range(sectors)]
+        for head in range(heads):
+            cells = encode_track(cyl, head, secs, encoding)
+            tno = cyl * 2 + head
+            table[tno] = data_start + len(body)
+            revs = [cells_to_flux(cells, scp.CELL_NS[encoding], rnd) for _ in range(revolutions)]
+            offs = 4 + revolutions * scp.REVOLUTION.size
+            hdr = bytearray(b"TRK" + bytes([tno]))
+            for flux in revs:
+                hdr += scp.REVOLUTION.pack(sum(flux), len(flux), offs)
+                offs += 2 * len(flux)
+            body += hdr + b"".join(struct.pack(f">{len(flux)}H", *flux) for flux in revs)
+    rest = scp.TRACK_TABLE.pack(*table) + body
+    n_tracks = max(tno for tno, offs in enumerate(table) if offs)
+    hdr = scp.HEADER.pack(b"SCP", 0x22, 0x80, revolutions, 0, n_tracks, 1, 0, 0 if heads == 2 else 1, 0,
+                          sum(rest) & 0xffffffff)
+    return hdr + rest
+
+
+def tram(docs=8, lines_per_doc=120, seed=0):
+    """TRAM IMD image with docs documents. Each track holds 42 lines of 78 characters."""
+    return raw_to_imd(tram_raw(docs, lines_per_doc, seed), SECTORS, SECTOR_SIZE)
+
+
+TRAM_FN_START = 3 * SECTOR_SIZE - 3
+# File names (12 bytes each) and the 0xff after the last one have to fit in the 5 header sectors
+TRAM_MAX_DOCS = (5 * SECTOR_SIZE - TRAM_FN_START - 1) // 12
+
+
+def tram_raw(docs=8, lines_per_doc=120, seed=0):
+    """The sectors of a TRAM image (see tram()), as a raw image.
+    Documents that don't fit in the 76 tracks are left out.
+    """
+    if not 0 <= docs <= TRAM_MAX_DOCS:
+        raise ValueError(f"a TRAM header has room for {TRAM_MAX_DOCS} documents, not {docs}")
+    rnd = random.Random(seed)
+    track_size = SECTORS * SECTOR_SIZE
+    raw = bytearray(b"\xe5" * (TRACKS * track_size))
+    hdr = bytearray(5 * SECTOR_SIZE)
+    hdr[0:5] = b"*TRAM"
+    hdr[156:156 + 76] = b"\xff" * 76      # document number for tracks 1..76
+    fn_start = TRAM_FN_START
+    track = 1
+    n_docs = 0
+    for doc_no in range(docs):
+        n_tracks = -(-lines_per_doc // 42)
+        if track + n_tracks > TRACKS:
+            break
+        n_docs += 1
+        hdr[fn_start + 12 * doc_no:fn_start + 12 * (doc_no + 1)] = f"DOC{doc_no:03}".ljust(12).encode("ascii")
+        for page in range(n_tracks):
+            hdr[156 + track - 1] = doc_no
+            tdata = bytearray(b"\xff" * track_size)
+            nlines = min(42, lines_per_doc - page * 42)
+            # lines are stored out of order on the disk
+            for slot, lno in enumerate(rnd.sample(range(nlines), nlines)):
+                line = bytes(c | 0x80 if rnd.random() < 0.05 else c for c in fill(rnd, 78))
+                tdata[slot * 79:(slot + 1) * 79] = bytes([lno]) + line
+            raw[track * track_size:(track + 1) * track_size] = tdata
+            track += 1
+    hdr[fn_start + 12 * n_docs] = 0xff
+    raw[0:len(hdr)] = hdr
+    return bytes(raw)
+
+
+def nd_date(year, month, day, hour=0, minute=0, second=0):
+    """Inverse of image_nd.parse_date"""
+    return (year - 1950) << 26 | month << 22 | day << 17 | hour << 12 | minute << 6 | second
+
+
+class NDBuilder:
+    """Builds an ND file system, page by page.
+
+    The object and user files are indexed (or subindexed), and a bit file marks the
+    used pages. Files can be stored contiguous ("c"), indexed ("i") or subindexed ("s").
+    The directory (object, user and bit files) goes after the file data, or at the start of the
+    medium (as on formatted diskettes) with directory_first.
+    """
+    IDX = 1 << 30
+    SUBIDX = 1 << 31
+
+    def __init__(self, seed=0):
+        self.rnd = random.Random(seed)
+        self.pages = [bytes(PAGE_SIZE)]       # page 0: master block
+        self.users = []
+        self.reserved = []      # pages set aside for the directory, used by alloc() first
+
+    def alloc(self, data=b""):
+        data = bytes(data).ljust(PAGE_SIZE, b"\x00")
+        if self.reserved:
+            pno = self.reserved.pop(0)
+            self.pages[pno] = data
+            return pno
+        self.pages.append(data)
+        return len(self.pages) - 1
+
+    def index_page(self, ptrs):
+        return self.alloc(struct.pack(f">{len(ptrs)}L", *ptrs))
+
+    def add_file_data(self, data, mode):
+        """Stores data, returns the file pointer"""
+        pages = [self.alloc(data[i:i + PAGE_SIZE]) for i in range(0, max(len(data), 1), PAGE_SIZE)]
+        return self.indexed(pages, mode)
+
+    def indexed(self, pages, mode):
+        """Returns a pointer to the pages (stored as the given mode)"""
+        entries = NDImage.INDEX_ENTRIES
+        match mode:
+            case "c":
+                assert pages == list(range(pages[0], pages[0] + len(pages))), "contiguous pages required"
+                return pages[0]
+            case "i":
+                assert len(pages) <= entries
+                return self.IDX | self.index_page(pages)
+            case "s":
+                idx_pages = [self.index_page(pages[i:i + entries]) for i in range(0, len(pages), entries)]
+                return self.SUBIDX | self.index_page(idx_pages)
+        raise ValueError(f"Unknown mode {mode}")
+
+    def add_user(self, name, files):
+        """files is a list of (name, type, data, mode)"""
+        self.users.append((name, files))
+
+    @staticmethod
+    def _name(name, size):
+        return (name + "'").encode("ascii").ljust(size, b"\x00")
+
+    def _directory_pages(self, obj_mode):
+        """The number of pages build() allocates for the directory"""
+        entry_pages = sum(-(-len(files) * ObjectEntry.SIZE // PAGE_SIZE) for _, files in self.users)
+        n_obj = len(self.users) * NDImage.OBJ_PAGES_PER_USER
+        obj_index = {"i": 1, "s": 1 + -(-n_obj // NDImage.INDEX_ENTRIES)}[obj_mode]
+        usr_pages = -(-len(self.users) * UserEntry.SIZE // PAGE_SIZE)
+        return entry_pages + obj_index + usr_pages + 1 + 1
+
+    def build(self, dir_name="SYNTH", obj_mode="i", date=nd_date(1979, 6, 15, 12, 30), directory_first=False):
+        if directory_first:
+            reserved = [self.alloc() for _ in range(self._directory_pages(obj_mode))]
+        user_entries = bytearray()
+        obj_entries = []      # the object entries of each user
+        for user_index, (uname, files) in enumerate(self.users):
+            user_entries += UserEntry.FORMAT.pack(0x8000, self._name(uname, 16), b"\x00\x00", date, date,
+                                                  1000, 100, user_index, 0, 0)
+            entries = bytearray()
+            for obj_index, (fname, ftype, data, mode) in enumerate(files):
+                fptr = self.add_file_data(data, mode)
+                n_pages = max(-(-len(data) // PAGE_SIZE), 1)
+                entries += ObjectEntry.FORMAT.pack(0x8000, self._name(fname, 16), self._name(ftype, 4), 0, 0,
+                                                   0o77777, 0, 0, user_index, obj_index, 0, 0,
+                                                   date, date, date, n_pages, max(len(data) - 1, 0), fptr)
+            obj_entries.append(entries)
+
+        if directory_first:
+            self.reserved = reserved
+        obj_pages = []        # logical object file pages, 8 per user
+        for entries in obj_entries:
+            pages = [self.alloc(entries[i:i + PAGE_SIZE]) for i in range(0, len(entries), PAGE_SIZE)]
+            obj_pages += (pages + [0] * NDImage.OBJ_PAGES_PER_USER)[:NDImage.OBJ_PAGES_PER_USER]
+        obj_ptr = self.indexed(obj_pages, obj_mode)
+        usr_pages = [self.alloc(user_entries[i:i + PAGE_SIZE]) for i in range(0, len(user_entries), PAGE_SIZE)]
+        usr_ptr = self.indexed(usr_pages, "i")
+
+        # Bit file: one bit per page (msb first), set if the page is in use.
+        bit_ptr = self.alloc()
+        assert not self.reserved, "pages reserved for the directory are left over"
+        n_pages = len(self.pages)
+        bits = bytearray(-(-n_pages // 8))
+        for pno in range(n_pages):
+            bits[pno // 8] |= 0x80 >> (pno % 8)
+        self.pages[bit_ptr] = bytes(bits).ljust(PAGE_SIZE, b"\x00")
+
+        master = bytearray(self.pages[0])
+        master[0x7e0:0x800] = struct.pack(">16sLLLL", self._name(dir_name, 16), obj_ptr, usr_ptr, bit_ptr, 0)
+        self.pages[0] = bytes(master)
+        return b"".join(self.pages)
+
+
+def nd(users=1, files=20, file_pages=3, subindexed=False, seed=0, directory_first=False):
+    """ND image with files per user. Every third file is contiguous, the rest are indexed,
+    or subindexed (if subindexed is set). See NDBuilder for directory_first.
+    """
+    rnd = random.Random(seed)
+    b = NDBuilder(seed)
+    for u in range(users):
+        user_files = []
+        for i in range(files):
+            data = fill(rnd, file_pages * PAGE_SIZE - rnd.randrange(1, PAGE_SIZE))
+            mode = "c" if i % 3 == 0 else ("s" if subindexed else "i")
+            user_files.append((f"F{i:04}", "SYMB", data, mode))
+        b.add_user(f"USER-{u}", user_files)
+    return b.build(obj_mode="s" if subindexed else "i", directory_first=directory_first)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Generate synthetic disk images")
+    ap.add_argument("format", choices=["mycron-prog", "mycron-data", "tram", "nd"])
+    ap.add_argument("out")
+    ap.add_argument("--entries", type=int, default=None, help="directory entries (mycron)")
+    ap.add_argument("--docs", type=int, default=8, help="documents (tram)")
+    ap.add_argument("--lines", type=int, default=120, help="lines per document (tram)")
+    ap.add_argument("--users", type=int, default=1, help="users (nd)")
+    ap.add_argument("--files", type=int, default=20, help="files per user (nd)")
+    ap.add_argument("--file-pages", type=int, default=3, help="pages per file (nd)")
+    ap.add_argument("--subindexed", action="store_true", help="use subindexed files and object file (nd)")
+    ap.add_argument("--directory-first", action="store_true", help="put the directory before the files (nd)")
+    ap.add_argument("--imd", action="store_true", help="store nd image as IMD (8 x 1024 byte sectors, head 1 a copy of head 0)")
+    ap.add_argument("--scp", action="store_true", help="store the image as an SCP flux capture (FM, MFM for nd, needs numpy)")
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args()
+
+    match args.format:
+        case "mycron-prog":
+            data = mycron_prog(args.entries if args.entries is not None else 152, seed=args.seed)
+        case "mycron-data":
+            data = mycron_data(args.entries if args.entries is not None else 19, seed=args.seed)
+        case "tram":
+            if args.scp:
+                data = raw_to_scp(tram_raw(args.docs, args.lines, seed=args.seed), SECTORS, SECTOR_SIZE)
+            else:
+                data = tram(args.docs, args.lines, seed=args.seed)
+        case "nd":
+            data = nd(args.users, args.files, args.file_pages, args.subindexed, seed=args.seed,
+                      directory_first=args.directory_first)
+            if args.scp:
+                data = raw_to_scp(data, 8, 1024, encoding="mfm", heads=2)
+            elif args.imd:
+                data = raw_to_imd(data, 8, 1024, heads=2)
+    if args.scp and args.format.startswith("mycron"):
+        data = raw_to_scp(data, SECTORS, SECTOR_SIZE)
+    with open(args.out, 'wb') as f:
+        f.write(data)
+
+
+if __name__ == '__main__':
+    main()
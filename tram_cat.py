@@ -3,49 +3,58 @@
 Tool to cat formatted TRAM documents.
 
 Documents are (mostly) in 7 bit ascii, but bit 8 is used to encode underlined characters.
+The documents are rendered in chunks, so large documents (or many of them in a pipeline)
+are streamed through without reading them into memory.
 """
 
-from rich.console import Console
+import re
+import sys
 import argparse
 
-USE_RICH=False
-USE_RICH=True
-
-console = Console()
-
-
-def val2chr(val):
-    v = val & 0x7f
-    c = bytes([v]).decode('latin1')
-    c2 = chr(v)
-    assert c == c2    # probably doesn't matter since we're decoding 7-bit ascii
-    return c
-
-
-def richify_tram_string(tstr):
-    ENC='latin1'
-    buf = ''
-    for cv in tstr:
-        c = val2chr(cv)
-        if cv > 0x7f:
-            if USE_RICH:
-                # buf += f"[bold]{c}[/bold]"
-                buf += f"\x1b[4m{c}\x1b[0m"
-            else:
-                buf += c
-        else:
-            buf += c
-    return buf
-
-ap = argparse.ArgumentParser()
-# ap.add_argument("-hex", action="store_true")
-ap.add_argument("fname", nargs='?')
-args = ap.parse_args()
-
-fname = args.fname
-with open(fname, 'rb') as f:
-    data = f.read()
-    lines = data.split(b"\n")
-    
-for line in lines:
-    print(richify_tram_string(line))
+UNDERLINE_ON = b"\x1b[4m"
+UNDERLINE_OFF = b"\x1b[0m"
+
+STRIP_BIT8 = bytes(v & 0x7f for v in range(256))     # translate table
+HIGH_CHARS = bytes(range(0x80, 0x100))
+UNDERLINED_RUN = re.compile(b"[\x80-\xff]+")
+
+
+def render_tram(data, underline=True):
+    """Returns data as 7 bit ascii, with each run of characters that have bit 8 set
+    underlined (if underline is set)
+    """
+    if underline:
+        data = UNDERLINED_RUN.sub(lambda m: UNDERLINE_ON + m.group() + UNDERLINE_OFF, data)
+    return data.translate(STRIP_BIT8)
+
+
+def render_stream(fin, fout, underline=True, chunk_size=1 << 16):
+    """Renders the document in fin to fout (both binary streams), chunk_size bytes at a time"""
+    carry = b''
+    while chunk := fin.read(chunk_size):
+        chunk = carry + chunk
+        # Keep a run of underlined characters at the end for the next chunk, so it isn't split in two
+        end = len(chunk.rstrip(HIGH_CHARS))
+        carry = chunk[end:]
+        fout.write(render_tram(chunk[:end], underline))
+    fout.write(render_tram(carry, underline))
+    fout.write(b"\n")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Prints TRAM documents, with underlined characters")
+    ap.add_argument("-p", "--plain", action="store_true", help="don't underline (only strip bit 8)")
+    ap.add_argument("fname", nargs='*', help="documents (default: stdin)")
+    args = ap.parse_args()
+
+    fout = sys.stdout.buffer
+    if not args.fname:
+        render_stream(sys.stdin.buffer, fout, not args.plain)
+    for fname in args.fname:
+        with open(fname, 'rb') as f:
+            render_stream(f, fout, not args.plain)
+    fout.flush()
+
+
+if __name__ == '__main__':
+    main()